@@ -0,0 +1,47 @@
+import json
+import logging
+import metrics
+import snapshot
+import tornado.ioloop
+
+logger = logging.getLogger('BokehLifecycle')
+logger.setLevel(logging.DEBUG)
+
+# Our metrics server, (opt-in) profiler, and snapshot refreshes live as long as our Bokeh server does.
+metrics_server = None
+profiler = None
+refresh_callback = None
+
+def on_server_loaded(server_context):
+    global metrics_server, profiler, refresh_callback
+    with open('config/config.json') as config_file:
+        config = json.load(config_file)
+
+    # Our metrics are started first (so they are still served if our snapshots can't be loaded).
+    metrics_server = metrics.serve(config['metrics']['websitePort'])
+    profiler = metrics.start_profiler(config['metrics']['profiler'], 'website')
+
+    # Our snapshots are loaded once for this process, and are shared by all of our sessions. Our unpartitioned store
+    # is loaded right away, while those of our partitions are loaded when their first session opens. Bokeh's server
+    # context has no periodic callbacks of its own, so our refreshes are scheduled on Tornado's IO loop.
+    try:
+        snapshot.get_store(config['databaseDescription']['location'],
+                           config['databaseDescription']['columnarExportLocation'])
+        logger.info('Snapshot store has been loaded.')
+    except snapshot.SnapshotUnavailable as e:
+        logger.error('Could not load our snapshot store! We will try again when our first session opens.')
+        logger.error(e)
+    refresh_callback = tornado.ioloop.PeriodicCallback(snapshot.refresh_stores,
+                                                       config['bokehLayout']['snapshotRefreshMilliseconds'])
+    refresh_callback.start()
+
+def on_server_unloaded(server_context):
+    if refresh_callback is not None:
+        refresh_callback.stop()
+    snapshot.close_stores()
+    logger.info('Snapshot stores have been closed.')
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if profiler is not None:
+        profiler.stop()
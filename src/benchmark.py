@@ -0,0 +1,525 @@
+import asyncio
+import copy
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import dotenv
+import nltk
+import nltk.corpus
+import nltk.tokenize
+import numpy
+import requests
+import canonical
+import database
+import indexer
+import scraper
+import snapshot
+import tokenizer
+import website
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
+logger = logging.getLogger('BenchmarkService')
+logger.setLevel(logging.DEBUG)
+
+# Our synthetic place names are built from these (so that the same seed always gives us the same names).
+NAME_SYLLABLES = ['ka', 'ki', 'ku', 'sa', 'shi', 'su', 'ta', 'chi', 'na', 'ni', 'ha', 'hi', 'ma', 'mi', 'ya',
+                  'yu', 'ra', 'ri', 'wa', 'to', 'ko', 'no', 'mo', 'ro']
+NAME_KINDS = ['Ramen', 'Sushi', 'Izakaya', 'Shrine', 'Temple', 'Onsen', 'Cafe', 'Tonkatsu', 'Yakitori', 'Market',
+              'Museum', 'Garden']
+FILLER_WORDS = ['we', 'should', 'go', 'to', 'the', 'this', 'is', 'on', 'my', 'at', 'for', 'a', 'i', 'want']
+DECORATIONS = ['!!', '?', '...', ' 🍜', ' ✨', ' :)']
+
+# Our (fake) businesses are spread around these cities.
+CITY_CENTERS = [('Tokyo', 35.68, 139.76), ('Kyoto', 35.01, 135.77), ('Osaka', 34.69, 135.50),
+                ('Sapporo', 43.06, 141.35), ('Fukuoka', 33.59, 130.40)]
+
+# Used for our latency summaries (i.e. we report the median and the tail).
+LATENCY_PERCENTILES = [50, 99]
+
+def summarize(latencies):
+    if len(latencies) == 0:
+        return {'count': 0}
+    latencies_ms = numpy.array(latencies) * 1000.0
+    summary = {'count': len(latencies), 'mean_ms': float(latencies_ms.mean())}
+    for p, v in zip(LATENCY_PERCENTILES, numpy.percentile(latencies_ms, LATENCY_PERCENTILES)):
+        summary[f'p{p}_ms'] = float(v)
+    return summary
+
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+# Channel histories that look like ours: most messages are chatter, some are tagged with a whitelisted reaction,
+# and many tagged messages mention a place that has already been mentioned (in some other form).
+class SyntheticHistory:
+    def __init__(self, seed, channel_count, messages_per_channel, reaction_ratio, duplicate_term_ratio,
+                 emoji_whitelist):
+        self.random = random.Random(seed)
+        self.channel_count = channel_count
+        self.messages_per_channel = messages_per_channel
+        self.reaction_ratio = reaction_ratio
+        self.duplicate_term_ratio = duplicate_term_ratio
+        self.emoji_whitelist = emoji_whitelist
+        self.places = list()
+        self.next_message_id = 10 ** 12
+
+    def new_place(self):
+        name = ''.join(self.random.choice(NAME_SYLLABLES) for _ in range(self.random.randint(2, 4)))
+        place = f'{name.capitalize()} {self.random.choice(NAME_KINDS)}'
+        self.places.append(place)
+        return place
+
+    def mention(self):
+        # A duplicate mention differs from the original in its case, word order, and decoration.
+        if len(self.places) == 0 or self.random.random() >= self.duplicate_term_ratio:
+            return self.new_place()
+        words = self.random.choice(self.places).split()
+        if self.random.random() < 0.5:
+            words.reverse()
+        mention = ' '.join(words)
+        mention = mention.lower() if self.random.random() < 0.5 else mention
+        return mention + self.random.choice(DECORATIONS)
+
+    def message(self, channel_name):
+        self.next_message_id += 1
+        is_tagged = self.random.random() < self.reaction_ratio
+        filler = [self.random.choice(FILLER_WORDS) for _ in range(self.random.randint(0, 4))]
+        content = ' '.join(filler + [self.mention()]) if is_tagged else ' '.join(filler + ['lol'])
+        return {
+            'id': self.next_message_id,
+            'author': f'traveler{self.random.randint(1, 6)}',
+            'channel': channel_name,
+            'content': content,
+            'created_at': '2023-01-01 00:00:00+00:00',
+            'jump_url': f'https://discord.com/channels/0/0/{self.next_message_id}',
+            'is_bot': self.random.random() < 0.02,
+            'reactions': [self.random.choice(self.emoji_whitelist)] if is_tagged else list()
+        }
+
+    def channels(self):
+        return {f'channel-{c}': [self.message(f'channel-{c}') for _ in range(self.messages_per_channel)]
+                for c in range(self.channel_count)}
+
+# A local stand-in for Yelp's search endpoint. Each term always gives back the same businesses, and some of our
+# requests are turned away with a 429 (just like Yelp would, once we go over our rate limit).
+class FakeYelpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, headers=None):
+        body = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or dict()).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency_seconds)
+        with self.server.lock:
+            self.server.request_count += 1
+            is_rate_limited = self.server.random.random() < self.server.rate_limit_ratio
+            self.server.rate_limited_count += int(is_rate_limited)
+        if is_rate_limited:
+            return self.respond(429, {'error': {'code': 'TOO_MANY_REQUESTS_PER_SECOND'}}, {'Retry-After': '0'})
+
+        term = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('term', [''])[0]
+        term_random = random.Random(hashlib.sha256(term.encode('UTF-8')).hexdigest())
+        businesses = list()
+        for i in range(term_random.randint(0, 5)):
+            city, latitude, longitude = term_random.choice(CITY_CENTERS)
+            kind = term_random.choice(NAME_KINDS)
+            businesses.append({
+                'id': hashlib.sha256(f'{term}:{i}'.encode('UTF-8')).hexdigest()[:22],
+                'alias': f'{term.replace(" ", "-")}-{i}',
+                'name': f'{term.title()} {i}',
+                'image_url': '',
+                'is_closed': term_random.random() < 0.05,
+                'url': f'https://www.yelp.com/biz/{term.replace(" ", "-")}-{i}',
+                'review_count': term_random.randint(0, 2000),
+                'categories': [{'alias': kind.lower(), 'title': kind}],
+                'rating': term_random.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]),
+                'coordinates': {'latitude': latitude + term_random.uniform(-0.1, 0.1),
+                                'longitude': longitude + term_random.uniform(-0.1, 0.1)},
+                'price': term_random.choice(['¥', '¥¥', '¥¥¥']),
+                'location': {'address1': f'{term_random.randint(1, 9)}-{term_random.randint(1, 30)}',
+                             'address2': '', 'address3': '', 'city': city, 'zip_code': '100-0001'},
+                'phone': ''
+            })
+        return self.respond(200, {'businesses': businesses, 'total': len(businesses)})
+
+class FakeYelpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_seconds, rate_limit_ratio, seed):
+        super().__init__(('localhost', 0), FakeYelpHandler)
+        self.latency_seconds = latency_seconds
+        self.rate_limit_ratio = rate_limit_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return f'http://localhost:{self.server_port}/v3/businesses/search'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# Our seeded databases hold the given number of links (i.e. message / location pairs), and are built through our
+# own migrations and point-of-interest ranking.
+def seed_database(location, link_count, links_per_message, seed):
+    seed_random = random.Random(seed)
+    message_count = max(link_count // links_per_message, 1)
+    location_count = max(link_count // (2 * links_per_message), links_per_message)
+
+    def locations():
+        for i in range(location_count):
+            city, latitude, longitude = seed_random.choice(CITY_CENTERS)
+            name = ''.join(seed_random.choice(NAME_SYLLABLES) for _ in range(seed_random.randint(2, 4)))
+            yield (f'seed-location-{i}', f'{name.capitalize()} {seed_random.choice(NAME_KINDS)}',
+                   f'{name}-{i}', f'https://www.yelp.com/biz/{name}-{i}',
+                   latitude + seed_random.uniform(-0.2, 0.2), longitude + seed_random.uniform(-0.2, 0.2),
+                   seed_random.choice([2.0, 3.0, 3.5, 4.0, 4.5, 5.0]), seed_random.randint(0, 2000),
+                   '1-1', city, '100-0001')
+
+    def messages():
+        for i in range(1, message_count + 1):
+            yield (i, canonical.canonicalize_term(f'seed term {i}'), 'traveler', 'channel', f'seed message {i}',
+                   '2023-01-01 00:00:00+00:00', f'https://discord.com/channels/0/0/{i}')
+
+    def links():
+        for i in range(1, message_count + 1):
+            for j in seed_random.sample(range(location_count), min(links_per_message, location_count)):
+                yield i, f'seed-location-{j}'
+
+    conn = sqlite3.connect(location)
+    database.migrate(conn)
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO JapanLocations (id, name, alias, yelp_url, coord_latitude, coord_longitude, rating,
+                                        review_count, location_address_1, location_city, location_zip_code)
+            VALUES                     (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, locations())
+        cursor.executemany("""
+            INSERT INTO JapanLocationsCategories (id, category, alias)
+            VALUES                               (?, ?, ?);
+        """, ((f'seed-location-{i}', k, k.lower()) for i in range(location_count)
+              for k in seed_random.sample(NAME_KINDS, 2)))
+        cursor.executemany("""
+            INSERT INTO DiscordMessages (id, search_term, author, channel, content, created_at, jump_url)
+            VALUES                      (?, ?, ?, ?, ?, ?, ?);
+        """, messages())
+        cursor.executemany("""
+            INSERT INTO MessagesToJapanLocations (discord_message_id, japan_locations_id)
+            VALUES                               (?, ?);
+        """, links())
+        database.refresh_points_of_interest(cursor, list(range(1, message_count + 1)))
+
+        # Our seeded links are not changes that any session has to catch up on.
+        database.prune_change_feed(cursor, 0)
+    conn.close()
+    return [f'seed-location-{i}' for i in range(location_count)]
+
+def is_tokenizer_ready():
+    # Our tokenizer needs the NLTK stopwords and our sentence tokenizer. We only try to download these once.
+    for attempt in range(2):
+        try:
+            nltk.corpus.stopwords.words('english')
+            nltk.tokenize.word_tokenize('')
+            return True
+        except LookupError:
+            if attempt == 0:
+                nltk.download('stopwords')
+                nltk.download('punkt')
+    return False
+
+async def benchmark_scraper(channels, emoji_whitelist, tokenizer_config, cache_location):
+    # This mirrors our refresh command: we keep the tagged messages of each channel, tokenize these, and merge each
+    # channel's entries into one inverted map. We run twice, so we see both a cold and a warm token cache.
+    message_tokenizer = tokenizer.Tokenizer(cache_location, tokenizer_config['tokenizerWorkers'],
+                                            tokenizer_config['tokenizerBatchSize'], tokenizer_config['lemmatize'])
+    results, index_entries = {'messages': sum(len(m) for m in channels.values())}, list()
+    try:
+        for pass_name in ['uncached', 'cached']:
+            start_time = time.perf_counter()
+            index_entries = list()
+            for channel_messages in channels.values():
+                tagged = [m for m in channel_messages
+                          if not m['is_bot'] and any(r in emoji_whitelist for r in m['reactions'])]
+                tokenized = await message_tokenizer.tokenize([m['content'] for m in tagged])
+                index_entries.extend((index_key, {**m, 'content': sanitized_message})
+                                     for m, (sanitized_message, index_key) in zip(tagged, tokenized))
+            inverted_map = scraper.build_inverted_map(index_entries)
+            elapsed_seconds = time.perf_counter() - start_time
+            results[pass_name] = {'seconds': elapsed_seconds,
+                                  'messages_per_second': results['messages'] / elapsed_seconds}
+            results['tagged_messages'] = len(index_entries)
+            results['distinct_terms'] = len(inverted_map)
+    finally:
+        message_tokenizer.shutdown()
+    return results, index_entries
+
+def canonical_index_entries(channels, emoji_whitelist, lemmatize):
+    # Without our tokenizer (i.e. no NLTK corpora), our index keys are only canonicalized (stopwords are kept).
+    return [(canonical.canonicalize_term(m['content'], lemmatize), m) for messages in channels.values()
+            for m in messages if not m['is_bot'] and any(r in emoji_whitelist for r in m['reactions'])]
+
+# Our indexer is started as its own process (i.e. exactly how it is deployed), within its own working directory.
+class IndexerProcess:
+    def __init__(self, work_directory, config):
+        self.work_directory = work_directory
+        self.config = config
+        self.process = None
+        self.log_file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.join(self.work_directory, 'config'), exist_ok=True)
+        with open(os.path.join(self.work_directory, 'config', 'config.json'), 'w') as config_file:
+            json.dump(self.config, config_file)
+        self.log_file = open(os.path.join(self.work_directory, 'indexer.log'), 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'indexer.py')],
+            cwd=self.work_directory, env={**os.environ, 'YELP_TOKEN': 'benchmark'},
+            stdout=self.log_file, stderr=subprocess.STDOUT)
+
+        # Wait for our indexer to start listening.
+        port = self.config['serviceDescription']['indexerPort']
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Indexer has exited early (see {self.log_file.name}).')
+            try:
+                socket.create_connection(('localhost', port), timeout=1).close()
+                return f'http://localhost:{port}'
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('Indexer did not start in time.')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            logger.warning('Indexer did not drain in time. Killing it.')
+            self.process.kill()
+            self.process.wait()
+        self.log_file.close()
+
+def benchmark_indexer(indexer_endpoint, index_entries, location_ids, benchmark_config, seed):
+    bench_random = random.Random(seed)
+    session = requests.Session()
+
+    # Our INDEX requests are built from the same (index key, message) entries our scraper produced, so duplicate
+    # mentions have already collapsed into one key (and so into one Yelp search).
+    terms_per_request = benchmark_config['termsPerIndexRequest']
+    request_latencies, job_latencies, terms_indexed = list(), list(), 0
+    for i in range(benchmark_config['indexRequests']):
+        batch = index_entries[i * terms_per_request:(i + 1) * terms_per_request]
+        if len(batch) == 0:
+            break
+        inverted_map = scraper.build_inverted_map(
+            (index_key, {k: v for k, v in m.items() if k not in {'is_bot', 'reactions'}}) for index_key, m in batch)
+
+        start_time = time.perf_counter()
+        response = session.request(indexer.OP_CODE_INDEX, indexer_endpoint, json=inverted_map)
+        request_latencies.append(time.perf_counter() - start_time)
+        if response.status_code != 202:
+            logger.error(f'INDEX request has returned {response.status_code}!')
+            logger.error(response.text)
+            continue
+
+        # Our job's own timestamps tell us how long it took (i.e. we don't count our polling interval).
+        while True:
+            job = session.get(indexer_endpoint + response.json()['status_url']).json()
+            if job['status'] in {indexer.JOB_STATUS_DONE, indexer.JOB_STATUS_FAILED}:
+                break
+            time.sleep(0.01)
+        job_latencies.append(job['finished_at'] - job['created_at'])
+        terms_indexed += job['terms_total']
+
+    delete_latencies = list()
+    for _ in range(benchmark_config['deleteRequests']):
+        deleted_ids = bench_random.sample(location_ids, min(benchmark_config['locationsPerDelete'],
+                                                            len(location_ids)))
+        start_time = time.perf_counter()
+        response = session.request(indexer.OP_CODE_DELETE, indexer_endpoint, json=deleted_ids)
+        delete_latencies.append(time.perf_counter() - start_time)
+        if response.status_code != 200:
+            logger.error(f'DELETE request has returned {response.status_code}!')
+            logger.error(response.text)
+
+    session.close()
+    return {
+        'index_requests': summarize(request_latencies),
+        'index_jobs': summarize(job_latencies),
+        'terms_indexed': terms_indexed,
+        'terms_per_second': terms_indexed / sum(job_latencies) if sum(job_latencies) > 0 else None,
+        'delete_requests': summarize(delete_latencies)
+    }
+
+def benchmark_website(run_config, benchmark_config, seed):
+    bench_random = random.Random(seed)
+
+    # Each of our runs loads its own snapshot (i.e. we don't want our last run's store).
+    snapshot.close_stores()
+    start_time = time.perf_counter()
+    layout = website.WebsiteLayout(**run_config)
+    load_seconds = time.perf_counter() - start_time
+    point_count = len(layout.view_snapshot)
+
+    # We alternate between a fresh selection (i.e. a new category) and paging within the current selection.
+    categories = [None, None] + [f'%{k}%' for k in NAME_KINDS[:3]]
+    limit = benchmark_config['viewLimit']
+    select_latencies, page_latencies, search_latencies = list(), list(), list()
+    snapshot_centroid_latencies, sql_centroid_latencies = list(), list()
+    conn = sqlite3.connect(f'file:{run_config["databaseDescription"]["location"]}?mode=ro', uri=True)
+    for _ in range(benchmark_config['viewQueries']):
+        category = bench_random.choice(categories)
+        start_time = time.perf_counter()
+        layout.refresh_view(limit=limit, category=category)
+        select_latencies.append(time.perf_counter() - start_time)
+
+        start_key = layout.view_key_at(bench_random.randrange(max(layout.view_selection_size(), 1)))
+        start_time = time.perf_counter()
+        layout.refresh_view(limit=limit, start_key=start_key, category=category)
+        page_latencies.append(time.perf_counter() - start_time)
+
+        # Our map is centered from our snapshot, but we also time the centroid query against our database.
+        group_rank = bench_random.randint(1, 5)
+        start_time = time.perf_counter()
+        layout.view_snapshot.centroid(group_rank)
+        snapshot_centroid_latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        conn.execute("""
+            WITH CoordinatesOfInterest AS (
+                SELECT JL.coord_latitude, JL.coord_longitude
+                FROM   PointsOfInterest POI, JapanLocations JL
+                WHERE  POI.location_id = JL.id AND POI.rank <= ?
+            )
+            SELECT AVG(coord_latitude), AVG(coord_longitude)
+            FROM   CoordinatesOfInterest;
+        """, (group_rank,)).fetchone()
+        sql_centroid_latencies.append(time.perf_counter() - start_time)
+
+        search_text = bench_random.choice(NAME_SYLLABLES) + bench_random.choice(NAME_SYLLABLES)
+        start_time = time.perf_counter()
+        layout.search_locations(search_text)
+        search_latencies.append(time.perf_counter() - start_time)
+    conn.close()
+
+    return {
+        'points_of_interest': point_count,
+        'snapshot_load_seconds': load_seconds,
+        'refresh_view_select': summarize(select_latencies),
+        'refresh_view_page': summarize(page_latencies),
+        'snapshot_centroid': summarize(snapshot_centroid_latencies),
+        'sql_centroid': summarize(sql_centroid_latencies),
+        'search_locations': summarize(search_latencies)
+    }
+
+def make_run_config(config, work_directory, yelp_endpoint):
+    # Each run gets its own database, export, and caches (and talks to our fake Yelp, on a free port).
+    benchmark_config = config['benchmark']
+    run_config = copy.deepcopy(config)
+    run_config['databaseDescription']['location'] = os.path.join(work_directory, 'out', 'japan-trip.db')
+    run_config['databaseDescription']['columnarExportLocation'] = \
+        os.path.join(work_directory, 'out', 'japan-trip.columns')
+    run_config['yelpSearch']['endpoint'] = yelp_endpoint
+    run_config['yelpSearch']['queriesPerSecond'] = benchmark_config['yelpQueriesPerSecond']
+    run_config['yelpSearch']['dailyQuota'] = 10 ** 9
+    run_config['yelpSearch']['cache']['location'] = os.path.join(work_directory, 'out', 'yelp-cache.db')
+    run_config['yelpSearch']['cache']['replayOnly'] = False
+    run_config['serviceDescription']['indexerPort'] = find_free_port()
+    run_config['freshness']['enabled'] = False
+    return run_config
+
+if __name__ == '__main__':
+    dotenv.load_dotenv()
+    with open('config/config.json') as config_file:
+        config = json.load(config_file)
+    benchmark_config = config['benchmark']
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'benchmark': benchmark_config,
+        'scraper': None,
+        'links': dict()
+    }
+
+    # Our synthetic channels are generated up front (so their generation is never part of our timings).
+    history = SyntheticHistory(benchmark_config['seed'], benchmark_config['channelCount'],
+                               benchmark_config['messagesPerChannel'], benchmark_config['reactionRatio'],
+                               benchmark_config['duplicateTermRatio'], config['discordSearch']['emojiWhitelist'])
+    channels = history.channels()
+
+    logger.info('Benchmarking our scraper (tokenization and inverted map).')
+    if is_tokenizer_ready():
+        with tempfile.TemporaryDirectory() as work_directory:
+            results['scraper'], index_entries = asyncio.run(benchmark_scraper(
+                channels, config['discordSearch']['emojiWhitelist'],
+                {**config['discordSearch'], **config['termCanonicalization']},
+                os.path.join(work_directory, 'token-cache.db')))
+        results['index_keys'] = 'tokenized'
+    else:
+        logger.error('Could not load the NLTK corpora our tokenizer needs. Skipping our scraper benchmark.')
+        index_entries = canonical_index_entries(channels, config['discordSearch']['emojiWhitelist'],
+                                                config['termCanonicalization']['lemmatize'])
+        results['index_keys'] = 'canonical'
+
+    fake_yelp = FakeYelpServer(benchmark_config['yelpLatencySeconds'], benchmark_config['yelpRateLimitRatio'],
+                               benchmark_config['seed'])
+    yelp_endpoint = fake_yelp.start()
+    for link_count in benchmark_config['linkCounts']:
+        with tempfile.TemporaryDirectory() as work_directory:
+            run_config = make_run_config(config, work_directory, yelp_endpoint)
+            os.makedirs(os.path.join(work_directory, 'out'))
+
+            logger.info(f'Seeding a database with {link_count} links.')
+            start_time = time.perf_counter()
+            location_ids = seed_database(run_config['databaseDescription']['location'], link_count,
+                                         benchmark_config['linksPerMessage'], benchmark_config['seed'])
+            run_results = {'seed_seconds': time.perf_counter() - start_time, 'locations': len(location_ids)}
+
+            logger.info(f'Benchmarking our indexer with {link_count} links.')
+            with IndexerProcess(work_directory, run_config) as indexer_endpoint:
+                run_results['indexer'] = benchmark_indexer(indexer_endpoint, index_entries, location_ids,
+                                                           benchmark_config, benchmark_config['seed'])
+
+            logger.info(f'Benchmarking our website with {link_count} links.')
+            run_results['website'] = benchmark_website(run_config, benchmark_config, benchmark_config['seed'])
+            snapshot.close_stores()
+            results['links'][str(link_count)] = run_results
+
+    results['yelp'] = {'requests': fake_yelp.request_count, 'rate_limited': fake_yelp.rate_limited_count}
+    fake_yelp.stop()
+
+    # Our results are kept (one file per run), so that runs can be compared with one another.
+    os.makedirs(benchmark_config['outputLocation'], exist_ok=True)
+    results_location = os.path.join(benchmark_config['outputLocation'],
+                                    f'benchmark-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(results_location, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    logger.info(f'Benchmark results have been written to {results_location}.')
@@ -0,0 +1,31 @@
+import unicodedata
+import emoji
+import nltk
+import nltk.stem
+
+# Variants of the same search term ("Ichiran Ramen", "ichiran ramen!!", "ramen Ichiran") all share one canonical form.
+# Both our scraper and our indexer use this, so variants share one Yelp search, one cached result, and one indexed term.
+lemmatizer = nltk.stem.WordNetLemmatizer()
+
+def download_corpora():
+    # Lemmatization needs the WordNet corpus (we should only need to download this once).
+    while True:
+        try:
+            lemmatizer.lemmatize('')
+            break
+        except LookupError:
+            nltk.download('wordnet')
+
+def is_kept_character(c):
+    # We drop all punctuation and symbols (this includes any emoji that are not in our emoji package).
+    return unicodedata.category(c)[0] not in {'P', 'S'}
+
+def canonicalize_term(search_term, lemmatize=False):
+    normalized_term = unicodedata.normalize('NFKC', emoji.replace_emoji(search_term, ' ')).casefold()
+    stripped_term = ''.join(c if is_kept_character(c) else ' ' for c in normalized_term)
+
+    # Our tokens are sorted (and de-duplicated), so the order of words in a message does not matter.
+    tokens = stripped_term.split()
+    if lemmatize:
+        tokens = [lemmatizer.lemmatize(t) for t in tokens]
+    return ' '.join(sorted(set(tokens)))
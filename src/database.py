@@ -1,6 +1,9 @@
 import os
+import re
 import sqlite3
+import sys
 import logging
+import canonical
 import dotenv
 import json
 
@@ -8,6 +11,478 @@ logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger = logging.getLogger('DatabaseInitializer')
 logger.setLevel(logging.DEBUG)
 
+# Each migration upgrades our database by one version (we keep track of our version using SQLite's user_version).
+# Never change a migration that has already been shipped! Add a new one to the end of this list instead.
+MIGRATIONS = [
+    # Version 1: our original schema.
+    """
+        -- Our entities...
+        CREATE TABLE IF NOT EXISTS DiscordMessages (
+            id          INTEGER PRIMARY KEY,
+            search_term TEXT NOT NULL,
+            author      TEXT NOT NULL,
+            channel     TEXT NOT NULL,
+            content     TEXT NOT NULL,
+            created_at  TEXT NOT NULL,
+            jump_url    TEXT NOT NULL,
+            UNIQUE(search_term)
+        );
+        CREATE TABLE IF NOT EXISTS JapanLocations (
+            id                 TEXT PRIMARY KEY,
+            name               TEXT NOT NULL,
+            alias              TEXT,
+            image_url          TEXT,
+            yelp_url           TEXT NOT NULL,
+            coord_latitude     TEXT NOT NULL,
+            coord_longitude    TEXT NOT NULL,
+            rating             INTEGER NOT NULL,
+            review_count       INTEGER NOT NULL,
+            price              TEXT,
+            location_address_1 TEXT NOT NULL,
+            location_address_2 TEXT,
+            location_address_3 TEXT,
+            location_city      TEXT NOT NULL,
+            location_zip_code  TEXT NOT NULL,
+            phone              TEXT
+        );
+        CREATE TABLE IF NOT EXISTS JapanLocationsCategories (
+            id       TEXT,
+            category TEXT,
+            alias    TEXT,
+            PRIMARY KEY (id, category),
+            FOREIGN KEY (id) REFERENCES JapanLocations
+        );
+        CREATE TABLE IF NOT EXISTS BlacklistedLocations (
+            id TEXT PRIMARY KEY
+        );
+
+        -- ...and our M:N relationships...
+        CREATE TABLE IF NOT EXISTS MessagesToJapanLocations (
+            discord_message_id INTEGER,
+            japan_locations_id TEXT,
+            PRIMARY KEY (discord_message_id, japan_locations_id),
+            FOREIGN KEY (discord_message_id) REFERENCES DiscordMessages,
+            FOREIGN KEY (japan_locations_id) REFERENCES JapanLocations
+        );
+    """,
+
+    # Version 2: our coordinates are stored as REALs, and we index the columns our website filters / joins on.
+    """
+        CREATE TABLE JapanLocationsTyped (
+            id                 TEXT PRIMARY KEY,
+            name               TEXT NOT NULL,
+            alias              TEXT,
+            image_url          TEXT,
+            yelp_url           TEXT NOT NULL,
+            coord_latitude     REAL NOT NULL,
+            coord_longitude    REAL NOT NULL,
+            rating             REAL NOT NULL,
+            review_count       INTEGER NOT NULL,
+            price              TEXT,
+            location_address_1 TEXT NOT NULL,
+            location_address_2 TEXT,
+            location_address_3 TEXT,
+            location_city      TEXT NOT NULL,
+            location_zip_code  TEXT NOT NULL,
+            phone              TEXT
+        );
+        INSERT INTO JapanLocationsTyped
+        SELECT      id, name, alias, image_url, yelp_url, CAST(coord_latitude AS REAL),
+                    CAST(coord_longitude AS REAL), CAST(rating AS REAL), review_count, price, location_address_1,
+                    location_address_2, location_address_3, location_city, location_zip_code, phone
+        FROM        JapanLocations;
+        DROP TABLE  JapanLocations;
+        ALTER TABLE JapanLocationsTyped RENAME TO JapanLocations;
+
+        -- Our website finds the messages of a location, and filters locations by their category / alias (LIKE is
+        -- case-insensitive, so these must use NOCASE to be of any use).
+        CREATE INDEX MessagesToJapanLocationsByLocation
+            ON MessagesToJapanLocations (japan_locations_id, discord_message_id);
+        CREATE INDEX JapanLocationsCategoriesByCategory
+            ON JapanLocationsCategories (category COLLATE NOCASE, id);
+        CREATE INDEX JapanLocationsCategoriesByAlias
+            ON JapanLocationsCategories (alias COLLATE NOCASE, id);
+    """,
+
+    # Version 3: our (ranked) points of interest are materialized, and are maintained by our indexer.
+    """
+        CREATE TABLE PointsOfInterest (
+            location_id  TEXT NOT NULL,
+            message_id   INTEGER NOT NULL,
+            review_count INTEGER NOT NULL,
+            rank         INTEGER NOT NULL,
+            PRIMARY KEY (message_id, location_id)
+        );
+        CREATE INDEX PointsOfInterestByRank
+            ON PointsOfInterest (rank, review_count DESC, location_id);
+        CREATE INDEX PointsOfInterestByLocation
+            ON PointsOfInterest (location_id);
+        INSERT INTO PointsOfInterest (location_id, message_id, review_count, rank)
+        SELECT      JLI.id, MJL.discord_message_id, JLI.review_count,
+                    RANK() OVER ( PARTITION BY MJL.discord_message_id
+                                  ORDER BY     JLI.review_count DESC )
+        FROM        JapanLocations JLI,
+                    MessagesToJapanLocations MJL
+        WHERE       MJL.japan_locations_id = JLI.id AND
+                    NOT EXISTS ( SELECT 1
+                                 FROM   BlacklistedLocations BL
+                                 WHERE  BL.id = JLI.id );
+    """,
+
+    # Version 4: every link and blacklisting is recorded in our change feed (which our website sessions tail). Our
+    # sequence is AUTOINCREMENT, so it never goes backwards (even after our feed has been pruned).
+    """
+        CREATE TABLE ChangeFeed (
+            sequence    INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind        TEXT NOT NULL,
+            message_id  INTEGER,
+            location_id TEXT,
+            created_at  TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TRIGGER ChangeFeedOnLink
+            AFTER INSERT ON MessagesToJapanLocations
+        BEGIN
+            INSERT INTO ChangeFeed (kind, message_id, location_id)
+            VALUES                 ('link', NEW.discord_message_id, NEW.japan_locations_id);
+        END;
+        CREATE TRIGGER ChangeFeedOnUnlink
+            AFTER DELETE ON MessagesToJapanLocations
+        BEGIN
+            INSERT INTO ChangeFeed (kind, message_id, location_id)
+            VALUES                 ('unlink', OLD.discord_message_id, OLD.japan_locations_id);
+        END;
+        CREATE TRIGGER ChangeFeedOnBlacklist
+            AFTER INSERT ON BlacklistedLocations
+        BEGIN
+            INSERT INTO ChangeFeed (kind, location_id)
+            VALUES                 ('blacklist', NEW.id);
+        END;
+    """,
+
+    # Version 5: our locations (their names, aliases, and categories) and our Discord messages are searchable. Our
+    # locations have no stable integer key, so their index holds its own copy of each location's text. Our messages are
+    # indexed in place.
+    """
+        CREATE VIRTUAL TABLE LocationsSearch USING fts5 (
+            location_id UNINDEXED,
+            name,
+            alias,
+            category,
+            category_alias,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+        INSERT INTO LocationsSearch (location_id, name, alias)
+        SELECT      id, name, alias
+        FROM        JapanLocations;
+        INSERT INTO LocationsSearch (location_id, category, category_alias)
+        SELECT      id, category, alias
+        FROM        JapanLocationsCategories;
+        CREATE TRIGGER LocationsSearchOnLocationInsert
+            AFTER INSERT ON JapanLocations
+        BEGIN
+            INSERT INTO LocationsSearch (location_id, name, alias)
+            VALUES                      (NEW.id, NEW.name, NEW.alias);
+        END;
+        CREATE TRIGGER LocationsSearchOnLocationUpdate
+            AFTER UPDATE OF name, alias ON JapanLocations
+        BEGIN
+            DELETE FROM LocationsSearch
+            WHERE       location_id = OLD.id AND 
+                        name IS NOT NULL;
+            INSERT INTO LocationsSearch (location_id, name, alias)
+            VALUES                      (NEW.id, NEW.name, NEW.alias);
+        END;
+        CREATE TRIGGER LocationsSearchOnCategoryInsert
+            AFTER INSERT ON JapanLocationsCategories
+        BEGIN
+            INSERT INTO LocationsSearch (location_id, category, category_alias)
+            VALUES                      (NEW.id, NEW.category, NEW.alias);
+        END;
+
+        CREATE VIRTUAL TABLE MessagesSearch USING fts5 (
+            content,
+            content = 'DiscordMessages',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+        INSERT INTO MessagesSearch (MessagesSearch) 
+        VALUES                     ('rebuild');
+        CREATE TRIGGER MessagesSearchOnInsert
+            AFTER INSERT ON DiscordMessages
+        BEGIN
+            INSERT INTO MessagesSearch (rowid, content)
+            VALUES                     (NEW.id, NEW.content);
+        END;
+        CREATE TRIGGER MessagesSearchOnDelete
+            AFTER DELETE ON DiscordMessages
+        BEGIN
+            INSERT INTO MessagesSearch (MessagesSearch, rowid, content)
+            VALUES                     ('delete', OLD.id, OLD.content);
+        END;
+    """,
+
+    # Version 6: many messages may share the same (canonical) search term, so search terms are no longer unique. Our
+    # message IDs are unchanged, so our message search index stays valid (only its triggers need to be recreated).
+    """
+        CREATE TABLE DiscordMessagesByTerm (
+            id          INTEGER PRIMARY KEY,
+            search_term TEXT NOT NULL,
+            author      TEXT NOT NULL,
+            channel     TEXT NOT NULL,
+            content     TEXT NOT NULL,
+            created_at  TEXT NOT NULL,
+            jump_url    TEXT NOT NULL
+        );
+        INSERT INTO DiscordMessagesByTerm
+        SELECT      id, search_term, author, channel, content, created_at, jump_url
+        FROM        DiscordMessages;
+        DROP TABLE  DiscordMessages;
+        ALTER TABLE DiscordMessagesByTerm RENAME TO DiscordMessages;
+        CREATE INDEX DiscordMessagesBySearchTerm
+            ON DiscordMessages (search_term);
+
+        CREATE TRIGGER MessagesSearchOnInsert
+            AFTER INSERT ON DiscordMessages
+        BEGIN
+            INSERT INTO MessagesSearch (rowid, content)
+            VALUES                     (NEW.id, NEW.content);
+        END;
+        CREATE TRIGGER MessagesSearchOnDelete
+            AFTER DELETE ON DiscordMessages
+        BEGIN
+            INSERT INTO MessagesSearch (MessagesSearch, rowid, content)
+            VALUES                     ('delete', OLD.id, OLD.content);
+        END;
+    """,
+
+    # Version 7: we remember when each search term and each location was last fetched from Yelp (our existing rows
+    # are treated as never fetched, so they are revalidated first). Updates to the columns our map shows are recorded
+    # in our change feed.
+    """
+        ALTER TABLE JapanLocations ADD COLUMN fetched_at REAL NOT NULL DEFAULT 0;
+        CREATE TABLE SearchTermFetches (
+            search_term TEXT PRIMARY KEY,
+            fetched_at  REAL NOT NULL
+        );
+        INSERT INTO SearchTermFetches (search_term, fetched_at)
+        SELECT DISTINCT search_term, 0
+        FROM            DiscordMessages;
+        CREATE INDEX SearchTermFetchesByFetchedAt
+            ON SearchTermFetches (fetched_at);
+
+        CREATE TRIGGER ChangeFeedOnLocationUpdate
+            AFTER UPDATE OF name, yelp_url, coord_latitude, coord_longitude, rating, review_count ON JapanLocations
+        BEGIN
+            INSERT INTO ChangeFeed (kind, location_id)
+            VALUES                 ('update', NEW.id);
+        END;
+    """,
+
+    # Version 8: our location and category indexes read their text from our tables (keyed by each row's rowid), so
+    # an update only touches the rows it changes (before, each update scanned our whole index for its location). Note
+    # that our tables have no INTEGER PRIMARY KEY, so a VACUUM must be followed by a 'rebuild' of both indexes.
+    """
+        DROP TRIGGER LocationsSearchOnLocationInsert;
+        DROP TRIGGER LocationsSearchOnLocationUpdate;
+        DROP TRIGGER LocationsSearchOnCategoryInsert;
+        DROP TABLE   LocationsSearch;
+
+        CREATE VIRTUAL TABLE LocationsSearch USING fts5 (
+            name,
+            alias,
+            content = 'JapanLocations',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+        INSERT INTO LocationsSearch (LocationsSearch)
+        VALUES                      ('rebuild');
+        CREATE TRIGGER LocationsSearchOnInsert
+            AFTER INSERT ON JapanLocations
+        BEGIN
+            INSERT INTO LocationsSearch (rowid, name, alias)
+            VALUES                      (NEW.rowid, NEW.name, NEW.alias);
+        END;
+        CREATE TRIGGER LocationsSearchOnUpdate
+            AFTER UPDATE OF name, alias ON JapanLocations
+            WHEN  OLD.name IS NOT NEW.name OR 
+                  OLD.alias IS NOT NEW.alias
+        BEGIN
+            INSERT INTO LocationsSearch (LocationsSearch, rowid, name, alias)
+            VALUES                      ('delete', OLD.rowid, OLD.name, OLD.alias);
+            INSERT INTO LocationsSearch (rowid, name, alias)
+            VALUES                      (NEW.rowid, NEW.name, NEW.alias);
+        END;
+        CREATE TRIGGER LocationsSearchOnDelete
+            AFTER DELETE ON JapanLocations
+        BEGIN
+            INSERT INTO LocationsSearch (LocationsSearch, rowid, name, alias)
+            VALUES                      ('delete', OLD.rowid, OLD.name, OLD.alias);
+        END;
+
+        CREATE VIRTUAL TABLE CategoriesSearch USING fts5 (
+            category,
+            alias,
+            content = 'JapanLocationsCategories',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+        INSERT INTO CategoriesSearch (CategoriesSearch)
+        VALUES                       ('rebuild');
+        CREATE TRIGGER CategoriesSearchOnInsert
+            AFTER INSERT ON JapanLocationsCategories
+        BEGIN
+            INSERT INTO CategoriesSearch (rowid, category, alias)
+            VALUES                       (NEW.rowid, NEW.category, NEW.alias);
+        END;
+        CREATE TRIGGER CategoriesSearchOnDelete
+            AFTER DELETE ON JapanLocationsCategories
+        BEGIN
+            INSERT INTO CategoriesSearch (CategoriesSearch, rowid, category, alias)
+            VALUES                       ('delete', OLD.rowid, OLD.category, OLD.alias);
+        END;
+    """,
+
+    # Version 9: the search terms we stored before version 6 are brought to their canonical form (so these are never
+    # searched for again, or revalidated as a variant of another term). Terms with no canonical form (e.g. only emoji)
+    # are left as they are, and are never revalidated.
+    """
+        UPDATE DiscordMessages
+        SET    search_term = canonicalize_term(search_term)
+        WHERE  canonicalize_term(search_term) NOT IN ('', search_term);
+
+        INSERT INTO SearchTermFetches (search_term, fetched_at)
+        SELECT      canonicalize_term(search_term), MAX(fetched_at)
+        FROM        SearchTermFetches
+        WHERE       canonicalize_term(search_term) NOT IN ('', search_term)
+        GROUP BY    canonicalize_term(search_term)
+        ON CONFLICT (search_term) DO UPDATE SET fetched_at = MAX(fetched_at, excluded.fetched_at);
+        DELETE FROM SearchTermFetches
+        WHERE       canonicalize_term(search_term) != search_term;
+    """
+]
+
+def register_functions(conn, lemmatize=False):
+    # Our statements may use the same canonical form of a search term as our scraper and our indexer.
+    conn.create_function('canonicalize_term', 1, lambda t: canonical.canonicalize_term(t, lemmatize),
+                         deterministic=True)
+
+def migrate(conn, lemmatize=False):
+    current_version = conn.execute('PRAGMA user_version;').fetchone()[0]
+    if current_version > len(MIGRATIONS):
+        raise sqlite3.DatabaseError(f'Database is at version {current_version}, but we only know of '
+                                    f'{len(MIGRATIONS)} versions!')
+
+    # Some of our migrations rewrite our search terms.
+    register_functions(conn, lemmatize)
+
+    # Each migration is applied in its own transaction (along with its version bump).
+    for version in range(current_version + 1, len(MIGRATIONS) + 1):
+        logger.info(f'Migrating our database from version {version - 1} to version {version}.')
+        try:
+            conn.executescript(f"""
+                BEGIN;
+                {MIGRATIONS[version - 1]}
+                PRAGMA user_version = {version};
+                COMMIT;
+            """)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return len(MIGRATIONS) - current_version
+
+def refresh_points_of_interest(cursor, message_ids):
+    # A location's rank is only dependent on the other locations of the same message, so we only need to recompute
+    # the ranks of the messages that have changed.
+    message_ids_json = json.dumps(list(message_ids))
+    cursor.execute("""
+        DELETE FROM PointsOfInterest
+        WHERE       message_id IN ( SELECT value
+                                    FROM   json_each(?) );
+    """, (message_ids_json,))
+    cursor.execute("""
+        INSERT INTO PointsOfInterest (location_id, message_id, review_count, rank)
+        SELECT      JLI.id, MJL.discord_message_id, JLI.review_count,
+                    RANK() OVER ( PARTITION BY MJL.discord_message_id
+                                  ORDER BY     JLI.review_count DESC )
+        FROM        JapanLocations JLI,
+                    MessagesToJapanLocations MJL
+        WHERE       MJL.japan_locations_id = JLI.id AND
+                    MJL.discord_message_id IN ( SELECT value
+                                                FROM   json_each(?) ) AND
+                    NOT EXISTS ( SELECT 1
+                                 FROM   BlacklistedLocations BL
+                                 WHERE  BL.id = JLI.id );
+    """, (message_ids_json,))
+
+def prune_change_feed(cursor, retention):
+    # We only keep our most recent changes. Sessions that have fallen further behind than this will reload everything.
+    # Our latest sequence is kept by SQLite (our feed uses AUTOINCREMENT), so it is still known once our feed is empty.
+    cursor.execute("""
+        DELETE FROM ChangeFeed
+        WHERE       sequence <= ( SELECT COALESCE(MAX(seq), 0)
+                                  FROM   sqlite_sequence
+                                  WHERE  name = 'ChangeFeed' ) - ?;
+    """, (retention,))
+
+def to_match_query(text):
+    # Each of our words is matched as a prefix (so the last word may still be in the middle of being typed). Quoting
+    # each word keeps FTS5 from reading our user's input as query syntax.
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text.casefold()))
+
+def search_locations(cursor, text, limit):
+    # Locations are ranked by the sum of their scores (lower is better for bm25), so a location whose name and whose
+    # messages both match comes before one that only matches on one of these. Names count for more than categories.
+    match_query = to_match_query(text)
+    if match_query == '':
+        return list()
+    cursor.execute("""
+        WITH     Matches (location_id, score) AS ( SELECT JL.id,
+                                                          bm25(LocationsSearch, 3.0, 3.0)
+                                                   FROM   LocationsSearch LS,
+                                                          JapanLocations JL
+                                                   WHERE  LocationsSearch MATCH :match_query AND
+                                                          JL.rowid = LS.rowid
+                                                   UNION ALL
+                                                   SELECT JLC.id,
+                                                          bm25(CategoriesSearch, 2.0, 2.0)
+                                                   FROM   CategoriesSearch CS,
+                                                          JapanLocationsCategories JLC
+                                                   WHERE  CategoriesSearch MATCH :match_query AND
+                                                          JLC.rowid = CS.rowid
+                                                   UNION ALL
+                                                   SELECT MJL.japan_locations_id,
+                                                          bm25(MessagesSearch)
+                                                   FROM   MessagesSearch MS,
+                                                          MessagesToJapanLocations MJL
+                                                   WHERE  MessagesSearch MATCH :match_query AND
+                                                          MJL.discord_message_id = MS.rowid )
+        SELECT   location_id
+        FROM     Matches
+        GROUP BY location_id
+        ORDER BY SUM(score)
+        LIMIT    :limit;
+    """, {'match_query': match_query, 'limit': limit})
+    return [row[0] for row in cursor.fetchall()]
+
+def reset(conn, lemmatize=False):
+    conn.executescript("""
+        DROP TABLE IF EXISTS DiscordMessages;
+        DROP TABLE IF EXISTS JapanLocations;
+        DROP TABLE IF EXISTS JapanLocationsCategories;
+        DROP TABLE IF EXISTS BlacklistedLocations;
+        DROP TABLE IF EXISTS MessagesToJapanLocations;
+        DROP TABLE IF EXISTS PointsOfInterest;
+        DROP TABLE IF EXISTS ChangeFeed;
+        DROP TABLE IF EXISTS LocationsSearch;
+        DROP TABLE IF EXISTS CategoriesSearch;
+        DROP TABLE IF EXISTS MessagesSearch;
+        DROP TABLE IF EXISTS SearchTermFetches;
+        PRAGMA user_version = 0;
+    """)
+    migrate(conn, lemmatize)
+
 if __name__ == '__main__':
     dotenv.load_dotenv()
     with open('config/config.json') as config_file:
@@ -15,72 +490,23 @@ if __name__ == '__main__':
 
     # Create the directory to hold database if it does not exist.
     db_location = config['databaseDescription']['location']
-    if not os.path.exists(db_location):
-        os.makedirs(db_location.split('/')[0])
+    if os.path.dirname(db_location) != '':
+        os.makedirs(os.path.dirname(db_location), exist_ok=True)
 
     try:
         # Open a connection to our database file.
         conn = sqlite3.connect(db_location)
-        cursor = conn.cursor()
-
-        # Initialize...
-        cursor.executescript("""
-            DROP TABLE IF EXISTS DiscordMessages;              
-            DROP TABLE IF EXISTS JapanLocations;          
-            DROP TABLE IF EXISTS JapanLocationsCategories;     
-            DROP TABLE IF EXISTS BlacklistedLocations;         
-            DROP TABLE IF EXISTS MessagesToJapanLocations;  
-            
-            -- Our entities...
-            CREATE TABLE DiscordMessages (
-                id          INTEGER PRIMARY KEY,
-                search_term TEXT NOT NULL,
-                author      TEXT NOT NULL,
-                channel     TEXT NOT NULL,
-                content     TEXT NOT NULL,
-                created_at  TEXT NOT NULL,
-                jump_url    TEXT NOT NULL,
-                UNIQUE(search_term)
-            );
-            CREATE TABLE JapanLocations (
-                id                 TEXT PRIMARY KEY,
-                name               TEXT NOT NULL,
-                alias              TEXT,
-                image_url          TEXT,
-                yelp_url           TEXT NOT NULL,
-                coord_latitude     TEXT NOT NULL,
-                coord_longitude    TEXT NOT NULL,
-                rating             INTEGER NOT NULL,
-                review_count       INTEGER NOT NULL,
-                price              TEXT,
-                location_address_1 TEXT NOT NULL,
-                location_address_2 TEXT,
-                location_address_3 TEXT,
-                location_city      TEXT NOT NULL,
-                location_zip_code  TEXT NOT NULL,
-                phone              TEXT
-            );
-            CREATE TABLE JapanLocationsCategories (
-                id       TEXT,
-                category TEXT,
-                alias    TEXT,
-                PRIMARY KEY (id, category),
-                FOREIGN KEY (id) REFERENCES JapanLocations
-            );
-            CREATE TABLE BlacklistedLocations (
-                id TEXT PRIMARY KEY
-            );
-            
-            -- ...and our M:N relationships...
-            CREATE TABLE MessagesToJapanLocations (
-                discord_message_id INTEGER,
-                japan_locations_id TEXT,
-                PRIMARY KEY (discord_message_id, japan_locations_id),
-                FOREIGN KEY (discord_message_id) REFERENCES DiscordMessages,
-                FOREIGN KEY (japan_locations_id) REFERENCES JapanLocations
-            );
-        """)
-        logger.info('Our database has been initialized.')
+        lemmatize = config['termCanonicalization']['lemmatize']
+        if lemmatize:
+            canonical.download_corpora()
+
+        # By default, we upgrade our database in place. Use "--reset" to start over with an empty database.
+        if '--reset' in sys.argv[1:]:
+            reset(conn, lemmatize)
+            logger.info('Our database has been initialized.')
+        else:
+            applied_count = migrate(conn, lemmatize)
+            logger.info(f'Our database has been migrated ({applied_count} migrations applied).')
 
     except sqlite3.Error as e:
         logger.error('Encountered error with our database!')
@@ -1,12 +1,24 @@
+import collections
+import contextlib
 import http.server
 import os
+import queue
+import signal
 import sqlite3
 import sys
-import urllib.parse
+import threading
+import time
+import uuid
+import zlib
+import canonical
+import database
+import metrics
+import partitions
+import snapshot
 import dotenv
 import logging
 import json
-import requests
+import yelp
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger = logging.getLogger('IndexerService')
@@ -15,151 +27,926 @@ logger.setLevel(logging.DEBUG)
 # We expose the following OP-CODEs.
 OP_CODE_INDEX = 'INDEX'
 OP_CODE_DELETE = 'DELETE'
+OP_CODE_RETRACT = 'RETRACT'
+
+# INDEX requests may also be streamed to us as (optionally gzip-compressed) newline-delimited JSON records.
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# These are served (along with those of our Yelp client and our database) from GET /metrics.
+requests_total = metrics.counter('indexer_requests_total', 'Requests handled by our indexer.', ('method', 'status'))
+index_phase_seconds = metrics.histogram('indexer_index_phase_seconds', 'Time spent in each phase of our INDEX jobs.',
+                                        ('phase',))
+index_job_seconds = metrics.histogram('indexer_index_job_seconds', 'Time taken by each of our INDEX jobs.',
+                                      ('status',))
+index_terms_total = metrics.counter('indexer_index_terms_total', 'Search terms processed by our INDEX jobs.',
+                                    ('result',))
+revalidated_terms_total = metrics.counter('indexer_revalidated_terms_total',
+                                          'Search terms revalidated by our freshness scheduler.', ('result',))
+
+def clean_yelp_businesses(raw_businesses):
+    clean_businesses = list()
+    null_handler = lambda s, n: s[n] if (n in s and s[n] != '' and
+                                         not (type(s[n]) == list and len(s[n]) == 0)) else None
+    required_attributes = {'id', 'name', 'coordinates', 'rating', 'review_count', 'location'}
+    for b in raw_businesses:
+        if 'is_closed' in b and b['is_closed']:
+            business_log.debug('Skipping business %s. This location is closed.', b.get('id'))
+            continue
+        if not required_attributes.issubset(b.keys()):
+            business_log.debug('Skipping business %s. Missing one of the required fields.', b.get('id'))
+            continue
+        business_log.debug('Business %s has been accepted.', b['id'])
+        clean_businesses.append({
+            'id': b['id'],
+            'name': b['name'],
+            'alias': null_handler(b, 'alias'),
+            'image_url': null_handler(b, 'image_url'),
+            'yelp_url': b['url'],
+            'coord_latitude': b['coordinates']['latitude'],
+            'coord_longitude': b['coordinates']['longitude'],
+            'rating': b['rating'],
+            'review_count': b['review_count'],
+            'price': null_handler(b, 'price'),
+            'location_address_1': b['location']['address1'],
+            'location_address_2': null_handler(b['location'], 'address2'),
+            'location_address_3': null_handler(b['location'], 'address3'),
+            'location_city': b['location']['city'],
+            'location_zip_code': b['location']['zip_code'],
+            'phone': null_handler(b, 'phone'),
+            'categories': null_handler(b, 'categories')
+        })
+    return clean_businesses
+
+# All rows produced by an INDEX request are staged here, and then written with set-based inserts.
+class IndexStage:
+    def __init__(self):
+        self.messages = list()
+        self.locations = dict()
+        self.categories = dict()
+        self.links = set()
+        self.fetched_terms = set()
+
+    def add(self, search_term, message_dicts, clean_businesses):
+        self.messages.extend({**m, **{'search_term': search_term}} for m in message_dicts)
+        self.fetched_terms.add(search_term)
+        for business in clean_businesses:
+            self.locations[business['id']] = business
+            if business['categories'] is not None:
+                for c in business['categories']:
+                    self.categories[(business['id'], c['title'])] = c['alias']
+
+        # We want to keep the association between our message and each of these businesses as well.
+        self.links.update((m['id'], b['id']) for m in message_dicts for b in clean_businesses)
+
+    def add_indexed(self, search_term, message_dicts, location_ids):
+        # This term has been searched for before, so our messages are linked to the locations that were found then.
+        self.messages.extend({**m, **{'search_term': search_term}} for m in message_dicts)
+        self.links.update((m['id'], i) for m in message_dicts for i in location_ids)
+
+    def write(self, cursor):
+        fetched_at = time.time()
+        cursor.executemany("""
+            INSERT INTO DiscordMessages (id, search_term, author, channel, content, created_at, jump_url)
+            VALUES                      (:id, :search_term, :author, :channel, :content, :created_at, :jump_url)
+            ON CONFLICT DO NOTHING;
+        """, self.messages)
+        cursor.executemany("""
+            INSERT INTO JapanLocations (id, name, alias, image_url, yelp_url, coord_latitude, coord_longitude,
+                                        rating, review_count, price, location_address_1, location_address_2, 
+                                        location_address_3, location_city, location_zip_code, phone, fetched_at)
+            VALUES                     (:id, :name, :alias, :image_url, :yelp_url, :coord_latitude, 
+                                        :coord_longitude, :rating, :review_count, :price, :location_address_1, 
+                                        :location_address_2, :location_address_3, :location_city, 
+                                        :location_zip_code, :phone, :fetched_at)
+            ON CONFLICT (id) DO NOTHING;
+        """, [{**b, 'fetched_at': fetched_at} for b in self.locations.values()])
+
+        # Our freshness scheduler revalidates the terms we have gone the longest without fetching. Note that our
+        # Yelp cache may have answered some of these (so this is when we last received a response, not when Yelp did).
+        cursor.executemany("""
+            INSERT INTO SearchTermFetches (search_term, fetched_at)
+            VALUES                        (?, ?)
+            ON CONFLICT (search_term) DO UPDATE SET fetched_at = excluded.fetched_at;
+        """, [(t, fetched_at) for t in self.fetched_terms])
+        cursor.executemany("""
+            INSERT INTO JapanLocationsCategories (id, category, alias) 
+            VALUES                               (?, ?, ?)
+            ON CONFLICT (id, category) DO NOTHING;
+        """, [(i, c, a) for (i, c), a in self.categories.items()])
+        cursor.executemany("""
+            INSERT INTO MessagesToJapanLocations (discord_message_id, japan_locations_id)
+            VALUES                               (?, ?)
+            ON CONFLICT (discord_message_id, japan_locations_id) DO NOTHING;
+        """, self.links)
+        database.refresh_points_of_interest(cursor, {m['id'] for m in self.messages} | {m for m, _ in self.links})
+
+# INDEX requests are processed as jobs, by a single background worker.
+JOB_STATUS_QUEUED = 'queued'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DONE = 'done'
+JOB_STATUS_FAILED = 'failed'
+
+# Our worker is fed by (search term) records from our caller, and by the searches it has given to Yelp.
+JOB_EVENT_RECORD = 'record'
+JOB_EVENT_RESULT = 'result'
+JOB_EVENT_END = 'end'
+
+class IndexJob:
+    def __init__(self, partition, is_streaming):
+        self.id = uuid.uuid4().hex
+        self.partition = partition
+        self.is_streaming = is_streaming
+        self.events = queue.Queue()
+        self.status = JOB_STATUS_QUEUED
+        self.records_received = 0
+        self.terms_total = 0
+        self.terms_done = 0
+        self.empty_terms = list()
+        self.error_terms = list()
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def add_record(self, search_term, message_dicts):
+        self.records_received += 1
+        self.events.put((JOB_EVENT_RECORD, search_term, message_dicts))
+
+    def end_records(self):
+        self.events.put((JOB_EVENT_END,))
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'partition': self.partition.name,
+            'status': self.status,
+            'is_streaming': self.is_streaming,
+            'records_received': self.records_received,
+            'terms_total': self.terms_total,
+            'terms_done': self.terms_done,
+            'terms_remaining': self.terms_total - self.terms_done,
+            'empty_terms': list(self.empty_terms),
+            'error_terms': list(self.error_terms),
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+# Each partition has its own worker (so one busy partition never holds up the jobs of another).
+class IndexJobQueue:
+    def __init__(self, max_finished_jobs=100):
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.queues = dict()
+        self.workers = list()
+
+    def submit(self, partition, inverted_map=None):
+        # Without a map, our caller will stream records to the job themselves (and end the job when they are done).
+        job = IndexJob(partition, is_streaming=inverted_map is None)
+        if inverted_map is not None:
+            for search_term, message_dicts in inverted_map.items():
+                job.add_record(search_term, message_dicts)
+            job.end_records()
+        with self.lock:
+            self.jobs[job.id] = job
+            if partition.name not in self.queues:
+                self.queues[partition.name] = queue.Queue()
+                worker = threading.Thread(target=self.run, args=(self.queues[partition.name],),
+                                          name=f'IndexWorker-{partition.name or "default"}')
+                worker.start()
+                self.workers.append(worker)
+            self.queues[partition.name].put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self, job_queue):
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            job.status = JOB_STATUS_RUNNING
+            try:
+                process_index_job(job)
+
+                # Streamed jobs whose records did not all arrive are still processed (as far as they got).
+                job.status = JOB_STATUS_DONE if job.error is None else JOB_STATUS_FAILED
+            except Exception as e:
+                logger.error(f'INDEX job {job.id} could not be processed!')
+                logger.error(e)
+                job.status, job.error = JOB_STATUS_FAILED, str(e)
+            job.finished_at = time.time()
+            index_job_seconds.observe(job.finished_at - job.created_at, status=job.status)
+
+            # We only keep around a handful of finished jobs.
+            with self.lock:
+                finished_jobs = [j for j in self.jobs.values() if j.finished_at is not None]
+                for j in finished_jobs[:max(0, len(finished_jobs) - self.max_finished_jobs)]:
+                    del self.jobs[j.id]
+
+    def shutdown(self):
+        # All queued jobs are processed before our workers exit.
+        with self.lock:
+            for job_queue in self.queues.values():
+                job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def process_index_job(job):
+    partition = job.partition
+    pending_map, clean_results, indexed_locations = dict(), dict(), dict()
+    outstanding_searches, is_ended, staged = 0, False, IndexStage()
+    while not is_ended or outstanding_searches > 0:
+        # Take everything that is available to us (i.e. our records are looked at in batches).
+        events = [job.events.get()]
+        while True:
+            try:
+                events.append(job.events.get_nowait())
+            except queue.Empty:
+                break
+
+        # The same term may appear in more than one record. We only search for it once.
+        new_map = dict()
+        for event in events:
+            if event[0] == JOB_EVENT_END:
+                is_ended = True
+            elif event[0] == JOB_EVENT_RECORD:
+                # Our callers may give us variants of the same term. These all share one (canonical) term.
+                search_term = canonical.canonicalize_term(
+                    event[1], partition.config['termCanonicalization']['lemmatize'])
+                message_dicts = event[2]
+                if search_term == '':
+                    # Nothing is left of this term (e.g. it was only punctuation or emoji), so there is nothing to find.
+                    logger.debug(f'Skipping search term {event[1]}. It has no canonical form.')
+                    continue
+                elif search_term in indexed_locations:
+                    staged.add_indexed(search_term, message_dicts, indexed_locations[search_term])
+                elif search_term in clean_results:
+                    staged.add(search_term, message_dicts, clean_results[search_term])
+                elif search_term in pending_map:
+                    pending_map[search_term].extend(message_dicts)
+                else:
+                    new_map.setdefault(search_term, list()).extend(message_dicts)
+
+        if len(new_map) > 0:
+            job.terms_total += len(new_map)
+            logger.debug(f'Records loaded. We have {len(new_map)} new terms.')
+
+            # Determine which terms we have not yet searched for, and the locations of those we have (all in one query).
+            lookup_start_time = time.perf_counter()
+            cursor = partition.database.reader().cursor()
+            cursor.execute("""
+                SELECT DISTINCT   DM.search_term, MJL.japan_locations_id
+                FROM              DiscordMessages DM
+                LEFT OUTER JOIN   MessagesToJapanLocations MJL
+                               ON MJL.discord_message_id = DM.id
+                WHERE             DM.search_term IN ( SELECT value 
+                                                      FROM   json_each(:search_terms) );
+            """, {"search_terms": json.dumps(list(new_map.keys()))})
+            indexed_search_terms = set()
+            for search_term, location_id in cursor.fetchall():
+                indexed_search_terms.add(search_term)
+                indexed_locations.setdefault(search_term, set())
+                if location_id is not None:
+                    indexed_locations[search_term].add(location_id)
+            for search_term in indexed_search_terms:
+                logger.info(f'Search term {search_term} has been indexed. '
+                            f'Linking to its {len(indexed_locations[search_term])} locations.')
+                staged.add_indexed(search_term, new_map[search_term], indexed_locations[search_term])
+            job.terms_done += len(indexed_search_terms)
+            index_terms_total.inc(len(indexed_search_terms), result='indexed')
+            index_phase_seconds.observe(time.perf_counter() - lookup_start_time, phase='lookup')
+
+            # Search for each remaining term using the Yelp API. We'll hear back from each search through our queue.
+            logger.info(f'Issuing {len(new_map) - len(indexed_search_terms)} search terms to Yelp.')
+            for search_term, message_dicts in new_map.items():
+                if search_term not in indexed_search_terms:
+                    pending_map[search_term] = message_dicts
+                    outstanding_searches += 1
+                    yelp_client.submit(search_term).add_done_callback(
+                        lambda f, t=search_term: job.events.put((JOB_EVENT_RESULT, t, f)))
+
+        # Stage all of our rows as each search completes...
+        for event in events:
+            if event[0] != JOB_EVENT_RESULT:
+                continue
+            _, search_term, future = event
+            outstanding_searches -= 1
+            job.terms_done += 1
+            message_dicts = pending_map.pop(search_term)
+            try:
+                yelp_json = future.result()
+            except Exception as e:
+                # This term will be searched for again on our next INDEX request.
+                logger.error(f'Yelp could not process search term {search_term}!')
+                logger.error(e)
+                job.error_terms.append(search_term)
+                index_terms_total.inc(result='error')
+                continue
+
+            # Do a bit of cleaning...
+            raw_businesses = yelp_json['businesses']
+            logger.info(f'Yelp has responded to {search_term}! Given {len(raw_businesses)} businesses.')
+            with index_phase_seconds.time(phase='clean'):
+                clean_results[search_term] = clean_yelp_businesses(raw_businesses)
+                staged.add(search_term, message_dicts, clean_results[search_term])
+
+            # Do we not have any business? Continue (and report this to our caller).
+            if len(clean_results[search_term]) == 0:
+                job.empty_terms.append(search_term)
+                index_terms_total.inc(result='empty')
+            else:
+                index_terms_total.inc(result='found')
+
+        # ...and write everything in a single transaction. For streams, we write as we go (in batches).
+        if job.is_streaming and \
+                len(staged.messages) >= partition.config['databaseDescription']['streamWriteBatchSize']:
+            write_index_stage(partition, staged)
+            staged = IndexStage()
+
+    write_index_stage(partition, staged)
+    logger.info(f'Yelp cache has seen {yelp_client.cache.hits} hits and {yelp_client.cache.misses} misses.')
+
+def write_index_stage(partition, staged):
+    with index_phase_seconds.time(phase='write'), partition.database.writer() as cursor:
+        staged.write(cursor)
+        database.prune_change_feed(cursor, partition.config['databaseDescription']['changeFeedRetention'])
+    logger.info(f'All **cleaned** businesses have been inserted into our database. '
+                f'Wrote {len(staged.messages)} messages, {len(staged.locations)} locations, '
+                f'and {len(staged.links)} links.')
+    if len(staged.messages) > 0 or len(staged.links) > 0:
+        partition.exporter.publish()
+
+# The rows of a batch of revalidated search terms are staged here. Unlike our INDEX stage, our locations are updated in
+# place (and closed locations are blacklisted).
+class RevalidationStage:
+    def __init__(self):
+        self.locations = dict()
+        self.categories = dict()
+        self.term_locations = set()
+        self.closed_ids = set()
+        self.fetched_terms = set()
+
+    def add(self, search_term, raw_businesses):
+        self.fetched_terms.add(search_term)
+        self.closed_ids.update(b['id'] for b in raw_businesses if 'id' in b and b.get('is_closed', False))
+        for business in clean_yelp_businesses(raw_businesses):
+            self.locations[business['id']] = business
+            self.term_locations.add((search_term, business['id']))
+            if business['categories'] is not None:
+                for c in business['categories']:
+                    self.categories[(business['id'], c['title'])] = c['alias']
+
+    def write(self, cursor):
+        fetched_at = time.time()
+
+        # Our locations are only updated if something about them has changed (our change feed records each update,
+        # so unchanged locations are never re-sent to our sessions). Each row is written on its own, so we know exactly
+        # which of our locations have been added or changed.
+        changed_ids = set()
+        for business in self.locations.values():
+            cursor.execute("""
+                INSERT INTO JapanLocations (id, name, alias, image_url, yelp_url, coord_latitude, coord_longitude,
+                                            rating, review_count, price, location_address_1, location_address_2,
+                                            location_address_3, location_city, location_zip_code, phone, fetched_at)
+                VALUES                     (:id, :name, :alias, :image_url, :yelp_url, :coord_latitude,
+                                            :coord_longitude, :rating, :review_count, :price, :location_address_1,
+                                            :location_address_2, :location_address_3, :location_city,
+                                            :location_zip_code, :phone, :fetched_at)
+                ON CONFLICT (id) DO UPDATE SET name               = excluded.name,
+                                               alias              = excluded.alias,
+                                               image_url          = excluded.image_url,
+                                               yelp_url           = excluded.yelp_url,
+                                               coord_latitude     = excluded.coord_latitude,
+                                               coord_longitude    = excluded.coord_longitude,
+                                               rating             = excluded.rating,
+                                               review_count       = excluded.review_count,
+                                               price              = excluded.price,
+                                               location_address_1 = excluded.location_address_1,
+                                               location_address_2 = excluded.location_address_2,
+                                               location_address_3 = excluded.location_address_3,
+                                               location_city      = excluded.location_city,
+                                               location_zip_code  = excluded.location_zip_code,
+                                               phone              = excluded.phone
+                                 WHERE         (name, alias, image_url, yelp_url, coord_latitude, coord_longitude,
+                                                rating, review_count, price, location_address_1, location_address_2,
+                                                location_address_3, location_city, location_zip_code, phone) IS NOT
+                                               (excluded.name, excluded.alias, excluded.image_url, excluded.yelp_url,
+                                                excluded.coord_latitude, excluded.coord_longitude, excluded.rating,
+                                                excluded.review_count, excluded.price, excluded.location_address_1,
+                                                excluded.location_address_2, excluded.location_address_3,
+                                                excluded.location_city, excluded.location_zip_code, excluded.phone);
+            """, {**business, 'fetched_at': fetched_at})
+            if cursor.rowcount > 0:
+                changed_ids.add(business['id'])
+        cursor.execute("""
+            UPDATE JapanLocations
+            SET    fetched_at = ?
+            WHERE  id IN ( SELECT value
+                           FROM   json_each(?) );
+        """, (fetched_at, json.dumps(list(self.locations.keys()))))
+        cursor.executemany("""
+            INSERT INTO JapanLocationsCategories (id, category, alias)
+            VALUES                               (?, ?, ?)
+            ON CONFLICT (id, category) DO NOTHING;
+        """, [(i, c, a) for (i, c), a in self.categories.items()])
+
+        # The messages of each term are linked to any location that Yelp has newly found for it (our existing links
+        # are kept as they are).
+        linked_terms = set()
+        for search_term, location_id in self.term_locations:
+            cursor.execute("""
+                INSERT INTO MessagesToJapanLocations (discord_message_id, japan_locations_id)
+                SELECT      id, ?
+                FROM        DiscordMessages
+                WHERE       search_term = ?
+                ON CONFLICT (discord_message_id, japan_locations_id) DO NOTHING;
+            """, (location_id, search_term))
+            if cursor.rowcount > 0:
+                linked_terms.add(search_term)
+
+        # Closed locations are blacklisted (i.e. just like a DELETE), but only those that we know of (and that have not
+        # already been blacklisted).
+        cursor.execute("""
+            INSERT INTO BlacklistedLocations (id)
+            SELECT      id
+            FROM        JapanLocations
+            WHERE       id IN ( SELECT value
+                                FROM   json_each(?) ) AND
+                        id NOT IN ( SELECT id
+                                    FROM   BlacklistedLocations )
+            RETURNING   id;
+        """, (json.dumps(list(self.closed_ids)),))
+        closed_ids = {row[0] for row in cursor.fetchall()}
+        cursor.executemany("""
+            INSERT INTO SearchTermFetches (search_term, fetched_at)
+            VALUES                        (?, ?)
+            ON CONFLICT (search_term) DO UPDATE SET fetched_at = excluded.fetched_at;
+        """, [(t, fetched_at) for t in self.fetched_terms])
+
+        # Our points of interest are only re-ranked for the messages that mention a location we have changed (or that
+        # have been given a new location).
+        cursor.execute("""
+            SELECT discord_message_id
+            FROM   MessagesToJapanLocations
+            WHERE  japan_locations_id IN ( SELECT value
+                                           FROM   json_each(?) )
+            UNION
+            SELECT id
+            FROM   DiscordMessages
+            WHERE  search_term IN ( SELECT value
+                                    FROM   json_each(?) );
+        """, (json.dumps(list(changed_ids | closed_ids)), json.dumps(list(linked_terms))))
+        message_ids = [row[0] for row in cursor.fetchall()]
+        if len(message_ids) > 0:
+            database.refresh_points_of_interest(cursor, message_ids)
+        return len(changed_ids), len(linked_terms), len(closed_ids)
+
+# Our stored Yelp data goes stale (places close, and their ratings and review counts change). In the background, we
+# search for the terms we have gone the longest without fetching, within a daily budget of our own (our searches
+# still go through our client's rate limit and quota).
+class FreshnessScheduler:
+    def __init__(self, freshness_config):
+        self.config = freshness_config
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='FreshnessScheduler')
+        self.budget_day, self.budget_used = None, 0
+        self.failed_terms = set()
+        self.rotation = 0
+
+    def start(self):
+        if not self.config['enabled']:
+            logger.info('Freshness scheduler is disabled.')
+        elif yelp_client.is_replay_only:
+            logger.info('Freshness scheduler is disabled (we cannot search Yelp in replay-only mode).')
+        else:
+            self.thread.start()
+
+    def remaining_budget(self):
+        # Our budget (and the terms we could not revalidate today) are reset at midnight (UTC).
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        if today != self.budget_day:
+            self.budget_day, self.budget_used = today, 0
+            self.failed_terms.clear()
+        return max(self.config['dailyBudget'] - self.budget_used, 0)
+
+    def run(self):
+        while not self.stop_event.wait(self.config['intervalSeconds']):
+            try:
+                self.revalidate()
+            except Exception as e:
+                logger.error('Could not revalidate our stored locations!')
+                logger.error(e)
+
+    def revalidate(self):
+        partition_names = [None]
+        if config['partitioning']['enabled']:
+            partition_names += partitions.find_partitions(config)
+
+        # We start from a different partition each time (so one partition can't use up all of our budget).
+        self.rotation = (self.rotation + 1) % len(partition_names)
+        for partition_name in partition_names[self.rotation:] + partition_names[:self.rotation]:
+            batch_size = min(self.config['batchSize'], self.remaining_budget())
+            if batch_size == 0:
+                logger.debug('Our freshness budget for today has been used.')
+                return
+            elif self.stop_event.is_set():
+                return
+            self.revalidate_partition(index_partitions.get(partition_name), batch_size)
+
+    def revalidate_partition(self, partition, batch_size):
+        cursor = partition.database.reader().cursor()
+        # Terms that we have never recorded a fetch for (e.g. those written by hand) are treated as the stalest. Terms
+        # that are not in their canonical form (i.e. variants of another term, or terms with nothing left to search for)
+        # are never revalidated.
+        cursor.execute("""
+            SELECT    DM.search_term
+            FROM      ( SELECT DISTINCT search_term
+                        FROM   DiscordMessages ) DM
+            LEFT JOIN SearchTermFetches STF ON STF.search_term = DM.search_term
+            WHERE     COALESCE(STF.fetched_at, 0) < :stale_before AND
+                      canonicalize_term(DM.search_term) = DM.search_term AND
+                      DM.search_term != '' AND
+                      DM.search_term NOT IN ( SELECT value
+                                              FROM   json_each(:failed_terms) )
+            ORDER BY  COALESCE(STF.fetched_at, 0)
+            LIMIT     :batch_size;
+        """, {
+            'stale_before': time.time() - self.config['maxAgeSeconds'],
+            'failed_terms': json.dumps([t for p, t in self.failed_terms if p == partition.name]),
+            'batch_size': batch_size
+        })
+        search_terms = [row[0] for row in cursor.fetchall()]
+        if len(search_terms) == 0:
+            return
+
+        # Our batch is searched for concurrently (and is written in a single transaction).
+        logger.info(f'Revalidating {len(search_terms)} search terms of partition {partition.name or "(default)"}.')
+        self.budget_used += len(search_terms)
+        staged = RevalidationStage()
+        with index_phase_seconds.time(phase='revalidate'):
+            for search_term, yelp_json, error in yelp_client.search_many(search_terms, is_revalidation=True):
+                if error is not None:
+                    logger.error(f'Yelp could not revalidate search term {search_term}!')
+                    logger.error(error)
+                    self.failed_terms.add((partition.name, search_term))
+                    revalidated_terms_total.inc(result='error')
+                    continue
+                staged.add(search_term, yelp_json['businesses'])
+                revalidated_terms_total.inc(result='found' if len(yelp_json['businesses']) > 0 else 'empty')
+            if len(staged.fetched_terms) == 0:
+                return
+
+            with partition.database.writer() as cursor:
+                changed_count, linked_count, closed_count = staged.write(cursor)
+                database.prune_change_feed(cursor, partition.config['databaseDescription']['changeFeedRetention'])
+        logger.info(f'Revalidated {len(staged.fetched_terms)} search terms. {changed_count} locations have been '
+                    f'added or changed, {linked_count} terms have new locations, and {closed_count} closed locations '
+                    f'have been blacklisted.')
+
+        # Our export is only rebuilt if our map has changed (otherwise, every website would remap the same data).
+        if changed_count > 0 or linked_count > 0 or closed_count > 0:
+            partition.exporter.publish()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+# After each write, we publish a columnar export of our map data. Every process of our website maps this same file.
+# Our exports are rebuilt from our whole database, so we never rebuild these in our request (or job) path. Instead,
+# each write marks our export as dirty, and our exporter's thread rebuilds it at most once every so often (i.e. the
+# writes made in the meantime are all published together).
+class ColumnarExporter:
+    def __init__(self, db_location, export_location, publish_interval_seconds):
+        self.export_location = export_location
+        self.publish_interval_seconds = publish_interval_seconds
+        self.conn = sqlite3.connect(db_location, isolation_level=None, check_same_thread=False,
+                                    factory=metrics.TimedConnection)
+        self.lock = threading.Lock()
+        self.version = snapshot.read_export_version(export_location)
+        self.dirty_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'ColumnarExporter-{os.path.basename(export_location)}')
+        self.thread.start()
+
+    def publish(self):
+        self.dirty_event.set()
+
+    def run(self):
+        while True:
+            self.dirty_event.wait()
+            if self.stop_event.is_set():
+                break
+            self.dirty_event.clear()
+            self.publish_now()
+            if self.stop_event.wait(self.publish_interval_seconds):
+                break
+
+    def publish_now(self):
+        # Each publish reads the latest committed state of our database, so our versions never go backwards.
+        with self.lock, index_phase_seconds.time(phase='publish'):
+            try:
+                map_snapshot = snapshot.read_snapshot(self.conn, self.version + 1)
+                snapshot.write_export(map_snapshot, self.export_location)
+                self.version = map_snapshot.version
+
+            except (sqlite3.Error, OSError) as e:
+                logger.error('Could not publish our columnar export!')
+                logger.error(e)
+                return
+
+        logger.info(f'Columnar export version {map_snapshot.version} has been published, '
+                    f'with {len(map_snapshot)} points of interest.')
+
+    def close(self):
+        # Any writes that have not yet been published are published before we close.
+        self.stop_event.set()
+        is_dirty = self.dirty_event.is_set()
+        self.dirty_event.set()
+        self.thread.join()
+        if is_dirty:
+            self.publish_now()
+        with self.lock:
+            self.conn.close()
+
+# Requests are served concurrently. Each thread reads from its own connection, while all writes go through a single
+# (serialized) connection.
+class IndexerDatabase:
+    def __init__(self, location, pragmas, lemmatize):
+        self.location = location
+        self.pragmas = pragmas
+        self.lemmatize = lemmatize
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.write_conn = self.connect()
+        self.read_conns = list()
+        self.read_conns_lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.location, check_same_thread=False, factory=metrics.TimedConnection)
+        for pragma_name, pragma_value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma_name} = {pragma_value};')
+        database.register_functions(conn, self.lemmatize)
+        return conn
+
+    def reader(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+            with self.read_conns_lock:
+                self.read_conns.append(self.local.conn)
+        return self.local.conn
+
+    def release_reader(self):
+        if hasattr(self.local, 'conn'):
+            with self.read_conns_lock:
+                self.read_conns.remove(self.local.conn)
+            self.local.conn.close()
+            del self.local.conn
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self.write_lock, self.write_conn:
+            yield self.write_conn.cursor()
+
+    def close(self):
+        with self.read_conns_lock:
+            for conn in self.read_conns:
+                conn.close()
+        with self.write_lock:
+            self.write_conn.close()
+
+# Each partition (i.e. Discord guild) has its own database and columnar export. Partitions are opened (and brought up
+# to date) on their first request.
+class IndexPartition:
+    def __init__(self, name, partition_config):
+        self.name = name
+        self.config = partition_config
+        db_location = self.config['databaseDescription']['location']
+        export_location = self.config['databaseDescription']['columnarExportLocation']
+        partitions.ensure_directory(db_location)
+        partitions.ensure_directory(export_location)
+        self.database = IndexerDatabase(db_location, self.config['databaseDescription']['pragmas'],
+                                        self.config['termCanonicalization']['lemmatize'])
+        with self.database.write_lock:
+            database.migrate(self.database.write_conn, self.config['termCanonicalization']['lemmatize'])
+
+        # Our website may be started before our first write, so we publish our current data right away.
+        self.exporter = ColumnarExporter(db_location, export_location,
+                                         self.config['databaseDescription']['exportIntervalSeconds'])
+        self.exporter.publish()
+
+    def close(self):
+        self.exporter.close()
+        self.database.close()
+
+class IndexPartitions:
+    def __init__(self, config):
+        self.config = config
+        self.partitions = dict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        # Without partitioning, everything goes to our unpartitioned database (so partition names are refused).
+        name = partitions.validate_partition(name)
+        if name is not None and not self.config['partitioning']['enabled']:
+            raise partitions.InvalidPartition(f'Partition {name} was given, but partitioning is disabled.')
+        with self.lock:
+            if name not in self.partitions:
+                # Each open partition holds its own connections and threads, so we only open so many of these.
+                if len(self.partitions) > self.config['partitioning']['maxOpenPartitions']:
+                    raise partitions.InvalidPartition(f'Partition {name} could not be opened. Too many partitions '
+                                                      f'are open.')
+                logger.info(f'Opening partition {name or "(default)"}.')
+                self.partitions[name] = IndexPartition(name, partitions.resolve_config(self.config, name))
+            return self.partitions[name]
+
+    def release_readers(self):
+        with self.lock:
+            for partition in self.partitions.values():
+                partition.database.release_reader()
+
+    def close(self):
+        with self.lock:
+            for partition in self.partitions.values():
+                partition.close()
+
+class IndexerServer(http.server.ThreadingHTTPServer):
+    # On shutdown, we wait for all of our handler threads to finish.
+    daemon_threads = False
+    block_on_close = True
 
 class IndexerService(http.server.BaseHTTPRequestHandler):
+    # We support keep-alive connections.
+    protocol_version = 'HTTP/1.1'
+
+    def finish(self):
+        super().finish()
+        index_partitions.release_readers()
+
     @staticmethod
-    def respond_to_client(handler, status_code, content):
+    def respond_to_client(handler, status_code, content, content_type='text/plain'):
+        # Our length is that of our encoded body (not of our string), otherwise our keep-alive connections would desync.
+        requests_total.inc(method=handler.command, status=status_code)
+        body = content.encode('UTF-8')
         handler.send_response(status_code)
-        handler.send_header('Content-type', 'text/plain')
-        handler.send_header('Content-Length', len(content))
-        handler.send_header('Connection', 'close')
+        handler.send_header('Content-type', content_type)
+        handler.send_header('Content-Length', len(body))
+        if getattr(handler.server, 'is_draining', False):
+            # We are shutting down, so we won't keep this connection alive.
+            handler.send_header('Connection', 'close')
+            handler.close_connection = True
         handler.end_headers()
-        handler.wfile.write(content.encode('UTF-8'))
+        handler.wfile.write(body)
         handler.wfile.flush()
 
+    def get_partition(self):
+        # Our caller names their partition with a header (requests without one go to our unpartitioned database).
+        try:
+            return index_partitions.get(self.headers.get(partitions.PARTITION_HEADER) or None)
+
+        except partitions.InvalidPartition as e:
+            logger.error('Could not route our request! Invalid partition given: ')
+            logger.error(e)
+            self.close_connection = True
+            IndexerService.respond_to_client(self, 400, str(e))
+            return None
+
+        except sqlite3.Error as e:
+            logger.error('Could not open our partition! Database error encountered: ')
+            logger.error(e)
+            self.close_connection = True
+            IndexerService.respond_to_client(self, 500, 'Partition could not be opened!')
+            return None
+
+    def read_body_chunks(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_line = self.rfile.readline()
+                if chunk_line == b'':
+                    raise ConnectionError('Connection was closed before our body was complete.')
+                chunk_size = int(chunk_line.split(b';')[0].strip(), 16)
+                if chunk_size == 0:
+                    # Skip over any trailers.
+                    while self.rfile.readline() not in {b'\r\n', b'\n', b''}:
+                        pass
+                    return
+                chunk = self.rfile.read(chunk_size)
+                self.rfile.readline()
+                yield chunk
+
+        else:
+            remaining_length = int(self.headers['Content-Length'])
+            while remaining_length > 0:
+                chunk = self.rfile.read(min(65536, remaining_length))
+                if len(chunk) == 0:
+                    raise ConnectionError('Connection was closed before our body was complete.')
+                remaining_length -= len(chunk)
+                yield chunk
+
+    def read_ndjson_records(self):
+        is_compressed = self.headers.get('Content-Encoding', '').lower() == 'gzip'
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16) if is_compressed else None
+
+        # Each line holds one JSON record. We give these back as soon as each line is complete.
+        buffer = b''
+        for chunk in self.read_body_chunks():
+            buffer += decompressor.decompress(chunk) if is_compressed else chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line.strip() != b'':
+                    yield json.loads(line)
+        if is_compressed:
+            buffer += decompressor.flush()
+        if buffer.strip() != b'':
+            yield json.loads(buffer)
+
     def do_INDEX(self):
+        if self.headers.get('Content-Type', '').split(';')[0] == NDJSON_CONTENT_TYPE:
+            return self.do_INDEX_stream()
+
+        partition = self.get_partition()
+        if partition is None:
+            return
+
         content_length = int(self.headers['Content-Length'])
         request_data = self.rfile.read(content_length)
         logger.debug(f'INDEX request received, of length {content_length}.')
 
-        # Using our caller's map, search for each index key using the Yelp API.
-        empty_search_terms, inverted_map = list(), json.loads(request_data)
-        logger.debug(f'Inverted map loaded. We have {len(inverted_map.keys())} terms.')
-        for search_term, message_dicts in inverted_map.items():
-            # First, check if we have already searched for this term. Look in our discord messages.
-            try:
-                cursor.execute("""
-                    SELECT 1
-                    FROM   DiscordMessages 
-                    WHERE  :search_term = search_term;
-                """, {"search_term": search_term})
-                if cursor.fetchone() is not None:
-                    logger.info(f'Search term {search_term} has been indexed. Skipping.')
-                    continue
+        # Our caller's map is processed in the background. They can follow along using the job's status URL.
+        job = index_jobs.submit(partition, json.loads(request_data))
+        logger.info(f'INDEX job {job.id} has been queued, with {job.records_received} terms.')
+        return IndexerService.respond_to_client(self, 202, json.dumps({
+            'job_id': job.id,
+            'status_url': f'/jobs/{job.id}'
+        }), 'application/json')
 
-                # ...otherwise, we have not searched for this term. Store our messages in our database.
-                for message_dict in message_dicts:
-                    cursor.execute("""
-                        INSERT INTO DiscordMessages (id, search_term, author, channel, content, created_at, jump_url)
-                        VALUES                      (:id, :search_term, :author, :channel, :content, :created_at, 
-                                                     :jump_url);
-                    """, {**message_dict, **{'search_term': search_term}})
-
-                # Issue a request to Yelp.
-                logger.info(f'Given search term {search_term}. Issuing request to Yelp.')
-                url = 'https://api.yelp.com/v3/businesses/search?' + \
-                      urllib.parse.urlencode({
-                          'location': config['yelpSearch']['location'],
-                          'limit': config['yelpSearch']['limit'],
-                          'term': search_term,
-                          'sort_by': 'best_match',
-                          'locale': 'en_US'
-                      }, safe="()", quote_via=urllib.parse.quote)
-                headers = {
-                    'accept': 'application/json',
-                    'Authorization': f'Bearer {os.getenv("YELP_TOKEN")}'
-                }
-                yelp_response = requests.get(url, headers=headers)
-                if not yelp_response.ok:
-                    logger.error('Yelp has returned a non-200 response code!')
-                    logger.error(yelp_response.content)
-                    return IndexerService.respond_to_client(self, 500, 'INDEX request could not be processed.')
-
-                # Do a bit of cleaning...
-                raw_businesses, clean_businesses = yelp_response.json()['businesses'], list()
-                null_handler = lambda s, n: s[n] if (n in s and s[n] != '' and
-                                                     not (type(s[n]) == list and len(s[n]) == 0)) else None
-                required_attributes = {'id', 'name', 'coordinates', 'rating', 'review_count', 'location'}
-                logger.info(f'Yelp has responded! Given {len(raw_businesses)} businesses.')
-                for b in raw_businesses:
-                    if 'is_closed' in b and b['is_closed']:
-                        logger.debug(f'Skipping businesses {b}. This location is closed.')
-                        continue
-                    if not required_attributes.issubset(b.keys()):
-                        logger.debug(f'Skipping businesses {b}. Missing one of the required fields.')
-                        continue
-                    logger.debug(f'Business {b} has been accepted.')
-                    clean_businesses.append({
-                        'id': b['id'],
-                        'name': b['name'],
-                        'alias': null_handler(b, 'alias'),
-                        'image_url': null_handler(b, 'image_url'),
-                        'yelp_url': b['url'],
-                        'coord_latitude': b['coordinates']['latitude'],
-                        'coord_longitude': b['coordinates']['longitude'],
-                        'rating': b['rating'],
-                        'review_count': b['review_count'],
-                        'price': null_handler(b, 'price'),
-                        'location_address_1': b['location']['address1'],
-                        'location_address_2': null_handler(b['location'], 'address2'),
-                        'location_address_3': null_handler(b['location'], 'address3'),
-                        'location_city': b['location']['city'],
-                        'location_zip_code': b['location']['zip_code'],
-                        'phone': null_handler(b, 'phone'),
-                        'categories': null_handler(b, 'categories')
-                    })
-
-                # Do we not have any business? Continue (and reply to our caller).
-                if len(clean_businesses) == 0:
-                    empty_search_terms.append(search_term)
-                    continue
+    def do_INDEX_stream(self):
+        logger.debug('Streamed INDEX request received.')
+        partition = self.get_partition()
+        if partition is None:
+            return
 
-                # ...and store these results in our database if we have not already stored them.
-                cursor.executemany("""
-                    INSERT INTO JapanLocations (id, name, alias, image_url, yelp_url, coord_latitude, coord_longitude,
-                                                rating, review_count, price, location_address_1, location_address_2, 
-                                                location_address_3, location_city, location_zip_code, phone)
-                    VALUES                     (:id, :name, :alias, :image_url, :yelp_url, :coord_latitude, 
-                                                :coord_longitude, :rating, :review_count, :price, :location_address_1, 
-                                                :location_address_2, :location_address_3, :location_city, 
-                                                :location_zip_code, :phone)
-                    ON CONFLICT (id) DO NOTHING;
-                """, clean_businesses)
-                for business in clean_businesses:
-                    if 'categories' in business and business['categories'] is not None:
-                        categories = [{'id': business['id'], 'category': c['title'], 'alias': c['alias']}
-                                      for c in business['categories']]
-                        cursor.executemany("""
-                            INSERT INTO JapanLocationsCategories (id, category, alias) 
-                            VALUES                               (:id, :category, :alias)
-                            ON CONFLICT (id, category) DO NOTHING;
-                        """, categories)
-
-                # We want to keep the association between our message and each of these businesses as well.
-                for message_dict in message_dicts:
-                    cursor.executemany("""
-                        INSERT INTO MessagesToJapanLocations (discord_message_id, japan_locations_id)
-                        VALUES                               (:discord_id, :yelp_id)
-                        ON CONFLICT (discord_message_id, japan_locations_id) DO NOTHING;
-                    """, [{'discord_id': message_dict['id'], 'yelp_id': s['id']} for s in clean_businesses])
-                logger.info('All **cleaned** businesses have been inserted into our database.')
-                conn.commit()
-
-            except sqlite3.Error as e:
-                logger.error('Could not process INSERT! Database error encountered: ')
-                logger.error(e)
-                return IndexerService.respond_to_client(self, 500, 'INDEX request could not be processed.')
-
-        # Respond to our caller.
-        if len(empty_search_terms) > 0:
-            empty_search_term_string = ','.join(f'"{s}"' for s in empty_search_terms)
-            return IndexerService.respond_to_client(
-                self, 199, f'Warning! INDEX request processed, but the following terms yielded no '
-                           f'Yelp results:\n{empty_search_term_string}')
-        else:
-            return IndexerService.respond_to_client(self, 200, 'INDEX request successfully processed.')
+        # Our records are processed as they arrive (i.e. while our caller is still sending us more). Our caller may
+        # take a while between records (e.g. while scanning a large channel), so our keep-alive timeout does not apply.
+        job = index_jobs.submit(partition)
+        logger.info(f'Streamed INDEX job {job.id} has been queued.')
+        self.connection.settimeout(config['serviceDescription']['streamReadSeconds'])
+        is_complete = False
+        try:
+            for record in self.read_ndjson_records():
+                job.add_record(record['search_term'], record['messages'])
+            is_complete = True
+
+        except (ValueError, KeyError, zlib.error) as e:
+            logger.error('Could not process INDEX stream! Malformed record encountered: ')
+            logger.error(e)
+            job.error = f'Malformed record encountered after {job.records_received} records.'
+            self.close_connection = True
+            return IndexerService.respond_to_client(self, 400, 'INDEX stream could not be processed.')
+
+        except OSError as e:
+            # Our caller has gone away (or has gone quiet for too long), so there is no one left to respond to.
+            logger.error('Could not read INDEX stream! Connection lost: ')
+            logger.error(e)
+            job.error = f'Connection lost after {job.records_received} records.'
+            self.close_connection = True
+            return
+
+        finally:
+            # Our job must always be ended, otherwise our partition's worker would wait on it forever.
+            if not is_complete and job.error is None:
+                job.error = f'INDEX stream ended after {job.records_received} records.'
+            job.end_records()
+            self.connection.settimeout(self.timeout)
+
+        logger.info(f'Streamed INDEX job {job.id} has received all {job.records_received} records.')
+        return IndexerService.respond_to_client(self, 202, json.dumps({
+            'job_id': job.id,
+            'status_url': f'/jobs/{job.id}'
+        }), 'application/json')
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            return IndexerService.respond_to_client(self, 200, metrics.registry.render(),
+                                                    metrics.PROMETHEUS_CONTENT_TYPE)
+
+        path_parts = self.path.strip('/').split('/')
+        if len(path_parts) == 2 and path_parts[0] == 'jobs':
+            job = index_jobs.get(path_parts[1])
+            if job is None:
+                return IndexerService.respond_to_client(self, 404, f'Job {path_parts[1]} does not exist.')
+            return IndexerService.respond_to_client(self, 200, json.dumps(job.to_dict()), 'application/json')
+
+        return IndexerService.respond_to_client(self, 404, f'Resource {self.path} does not exist.')
 
     def do_DELETE(self):
+        partition = self.get_partition()
+        if partition is None:
+            return
+
         content_length = int(self.headers['Content-Length'])
         request_data = self.rfile.read(content_length)
         logger.debug(f'DELETE request received, of length {content_length}.')
@@ -168,12 +955,23 @@ class IndexerService(http.server.BaseHTTPRequestHandler):
         location_ids = json.loads(request_data)
         try:
             # Note: our DELETE is not physical, this simply tells our application to not display these in the future.
-            cursor.executemany("""
-                INSERT INTO BlacklistedLocations (id)
-                VALUES                           (?)
-                ON CONFLICT (id) DO NOTHING;
-            """, tuple([(i,) for i in location_ids]))
-            conn.commit()
+            with partition.database.writer() as cursor:
+                cursor.executemany("""
+                    INSERT INTO BlacklistedLocations (id)
+                    VALUES                           (?)
+                    ON CONFLICT (id) DO NOTHING;
+                """, tuple([(i,) for i in location_ids]))
+
+                # Our points of interest are re-ranked for every message that mentions these locations.
+                cursor.execute("""
+                    SELECT DISTINCT discord_message_id
+                    FROM            MessagesToJapanLocations
+                    WHERE           japan_locations_id IN ( SELECT value
+                                                            FROM   json_each(?) );
+                """, (json.dumps(location_ids),))
+                database.refresh_points_of_interest(cursor, [row[0] for row in cursor.fetchall()])
+                database.prune_change_feed(cursor, partition.config['databaseDescription']['changeFeedRetention'])
+            partition.exporter.publish()
 
             # Respond to our caller.
             return IndexerService.respond_to_client(self, 200, 'DELETE request successfully processed.')
@@ -183,31 +981,107 @@ class IndexerService(http.server.BaseHTTPRequestHandler):
             logger.error(e)
             return IndexerService.respond_to_client(self, 500, 'DELETE request could not be processed!')
 
+    def do_RETRACT(self):
+        partition = self.get_partition()
+        if partition is None:
+            return
+
+        content_length = int(self.headers['Content-Length'])
+        request_data = self.rfile.read(content_length)
+        logger.debug(f'RETRACT request received, of length {content_length}.')
+
+        # We expect a list of Discord message IDs (i.e. messages that are no longer tagged, edited, or deleted).
+        message_ids = json.loads(request_data)
+        try:
+            with partition.database.writer() as cursor:
+                cursor.executemany("""
+                    DELETE FROM MessagesToJapanLocations
+                    WHERE       discord_message_id = ?;
+                """, tuple([(i,) for i in message_ids]))
+                cursor.executemany("""
+                    DELETE FROM DiscordMessages
+                    WHERE       id = ?;
+                """, tuple([(i,) for i in message_ids]))
+
+                # Messages that we never indexed leave our map (and our export) as they are.
+                retracted_count = cursor.rowcount
+                if retracted_count > 0:
+                    database.refresh_points_of_interest(cursor, message_ids)
+                    database.prune_change_feed(cursor, partition.config['databaseDescription']['changeFeedRetention'])
+            if retracted_count > 0:
+                partition.exporter.publish()
+
+            # Respond to our caller.
+            return IndexerService.respond_to_client(self, 200, 'RETRACT request successfully processed.')
+
+        except sqlite3.Error as e:
+            logger.error('Could not process RETRACT! Database error encountered: ')
+            logger.error(e)
+            return IndexerService.respond_to_client(self, 500, 'RETRACT request could not be processed!')
+
 if __name__ == '__main__':
     dotenv.load_dotenv()
     with open('config/config.json') as config_file:
         config = json.load(config_file)
 
-    # Open a connection to our database.
+    # We only log one of every so many businesses (our profiler is opt-in).
+    business_log = metrics.LogSampler(logger, config['metrics']['logSampleEvery'])
+    profiler = metrics.start_profiler(config['metrics']['profiler'], 'indexer')
+
+    # Lemmatizing our search terms requires a corpus that we may not have yet (our migrations use this as well).
+    # Any of our partitions may turn this on for itself.
+    if config['termCanonicalization']['lemmatize'] or any(
+            overrides.get('termCanonicalization', dict()).get('lemmatize', False)
+            for overrides in config['partitioning']['overrides'].values()):
+        canonical.download_corpora()
+
+    # Open a connection to our (unpartitioned) database, and bring it up to date (this never drops any of our data).
+    # The databases of our partitions are opened as their requests come in.
+    index_partitions = IndexPartitions(config)
     try:
-        db_location = config['databaseDescription']['location']
-        conn = sqlite3.connect(db_location)
-        cursor = conn.cursor()
+        index_partitions.get(None)
 
     except sqlite3.Error as err:
         logger.error('Encountered error with our database!')
         logger.error(err)
         sys.exit(1)
 
-    # Start our indexer service.
-    server = http.server.HTTPServer(('localhost', config['serviceDescription']['indexerPort']), IndexerService)
+    # All of our Yelp searches go through a shared (rate-limited) client.
+    yelp_client = yelp.YelpClient(os.getenv('YELP_TOKEN'), **config['yelpSearch'])
+
+    # All INDEX requests are processed by our background workers (one per partition).
+    index_jobs = IndexJobQueue()
+
+    # Our stored locations are revalidated in the background.
+    freshness_scheduler = FreshnessScheduler(config['freshness'])
+    freshness_scheduler.start()
+
+    # Start our indexer service. By default, each connection is handled by its own thread.
+    server_address = ('localhost', config['serviceDescription']['indexerPort'])
+    if config['serviceDescription']['indexerConcurrent']:
+        server = IndexerServer(server_address, IndexerService)
+    else:
+        server = http.server.HTTPServer(server_address, IndexerService)
+    server.is_draining = False
+    IndexerService.timeout = config['serviceDescription']['keepAliveSeconds']
     logger.info('Indexer service has started.')
 
+    # We'll also drain on SIGTERM (the shutdown must be issued from a thread other than our server's).
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         logger.info('Indexer service has been interrupted.')
         pass
 
+    # Let our in-flight requests and queued INDEX jobs finish before closing our databases.
+    logger.info('Indexer service is draining.')
+    server.is_draining = True
     server.server_close()
+    index_jobs.shutdown()
+    freshness_scheduler.stop()
+    yelp_client.shutdown()
+    index_partitions.close()
+    if profiler is not None:
+        profiler.stop()
     logger.info('Indexer service has been shutdown.')
@@ -2,9 +2,12 @@ import json
 import sys
 import dotenv
 import bokeh.io
+import bokeh.models
 import bokeh.plotting
 import logging
 
+import partitions
+import snapshot
 import website
 
 logger = logging.getLogger('BokehEntryPoint')
@@ -17,9 +20,29 @@ with open('config/config.json') as config_file:
     logger.info(f'Configuration loaded: {config}')
 logger.info('Starting up! Bokeh has called us.')
 
-# Set up the layout for our web-app.
-layout = website.WebsiteLayout(**config)()
-bokeh.io.curdoc().add_root(layout)
+# Each session shows a single partition (i.e. one guild's trip), given by our "partition" query argument. This is
+# ignored if we are not partitioning.
+session_arguments = bokeh.io.curdoc().session_context.request.arguments
+partition = None
+if config['partitioning']['enabled'] and 'partition' in session_arguments:
+    partition = session_arguments['partition'][0].decode('UTF-8', errors='replace')
+
+# Set up the layout for our web-app. If this session can't be opened, only this session is given an error page (our
+# other sessions are left alone).
+try:
+    config = partitions.resolve_config(config, partition, must_exist=True)
+    website_layout = website.WebsiteLayout(**config)
+except (partitions.InvalidPartition, snapshot.SnapshotUnavailable) as e:
+    logger.error('Could not open our session!')
+    logger.error(e)
+    website_layout = None
+
+if website_layout is not None:
+    bokeh.io.curdoc().add_root(website_layout())
+    bokeh.io.curdoc().add_periodic_callback(website_layout.on_snapshot_check,
+                                            config['bokehLayout']['snapshotRefreshMilliseconds'])
+else:
+    bokeh.io.curdoc().add_root(bokeh.models.Div(text='<h3>This trip could not be found (or is not ready yet).</h3>'))
 bokeh.io.curdoc().title = config['bokehLayout']['title']
 
 if __name__ == '__main__':
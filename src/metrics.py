@@ -0,0 +1,279 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+logger = logging.getLogger('MetricsService')
+logger.setLevel(logging.DEBUG)
+
+# Our latency buckets (in seconds), from a tenth of a millisecond up to ten seconds.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(label_names, label_values, extra_labels=()):
+    labels = list(zip(label_names, label_values)) + list(extra_labels)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{n}="{escape_label_value(v)}"' for n, v in labels) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with self.lock:
+            self.values[key] += amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.label_names, key), value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        # We only count into one bucket here. Our buckets are made cumulative when they are rendered.
+        key = tuple(str(labels[n]) for n in self.label_names)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.series.items())
+        for key, (bucket_counts, total, count) in series:
+            cumulative_count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative_count += bucket_count
+                yield self.name + '_bucket' + \
+                    format_labels(self.label_names, key, [('le', format_value(float(bound)))]), cumulative_count
+            yield self.name + '_sum' + format_labels(self.label_names, key), total
+            yield self.name + '_count' + format_labels(self.label_names, key), count
+
+# All of the metrics of our process live here (each of our modules registers its own, just like its logger).
+class Registry:
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        # Our metrics are given back in Prometheus' text format.
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = list()
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{sample_name} {format_value(value)}' for sample_name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def counter(name, description, label_names=()):
+    return registry.register(Counter(name, description, label_names))
+
+def histogram(name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, description, label_names, buckets))
+
+# Every statement we give to SQLite is timed. Our statements are labelled by their verb and the first table they
+# name (e.g. "INSERT JapanLocations"), so our label count stays small.
+sqlite_statement_seconds = histogram('sqlite_statement_seconds', 'Time spent executing SQLite statements.',
+                                     ('statement',))
+STATEMENT_TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)', re.IGNORECASE)
+MAX_STATEMENT_LABELS = 1000
+statement_labels = dict()
+
+def statement_label(sql):
+    label = statement_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        table_match = STATEMENT_TABLE_PATTERN.search(sql)
+        label = (words[0].rstrip(';').upper() if len(words) > 0 else '') + \
+            ('' if table_match is None else f' {table_match.group(1)}')
+        if len(statement_labels) < MAX_STATEMENT_LABELS:
+            statement_labels[sql] = label
+    return label
+
+class TimedCursor(sqlite3.Cursor):
+    # Note: for our SELECTs, this only covers the statement's first step (the rest happens as rows are fetched).
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start_time, statement=statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start_time, statement=statement_label(sql))
+
+    def executescript(self, sql_script):
+        start_time = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start_time, statement='SCRIPT')
+
+# Pass this as the factory of sqlite3.connect. The shortcuts on our connection (execute, executemany, ...) do not
+# call our cursor method on their own, so these are routed through our cursor here.
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+# Our per-item logs (e.g. one for every message or every business) are costly at volume, so we only keep one of
+# every so many. Our arguments are only formatted if that log is kept.
+class LogSampler:
+    def __init__(self, logger, every):
+        self.logger = logger
+        self.every = max(int(every), 1)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def debug(self, message, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        with self.lock:
+            self.count += 1
+            is_sampled = (self.count - 1) % self.every == 0
+        if is_sampled:
+            self.logger.debug(message, *args)
+
+# Processes without an HTTP server of their own (i.e. our scraper and our website) serve their metrics from here.
+class MetricsService(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            content, status_code, content_type = f'Resource {self.path} does not exist.', 404, 'text/plain'
+        else:
+            content, status_code, content_type = registry.render(), 200, PROMETHEUS_CONTENT_TYPE
+        content = content.encode('UTF-8')
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+def serve(port):
+    if port is None:
+        return None
+    try:
+        server = http.server.ThreadingHTTPServer(('localhost', port), MetricsService)
+    except OSError as e:
+        logger.error(f'Could not serve our metrics on port {port}!')
+        logger.error(e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f'Metrics are being served at http://localhost:{port}/metrics.')
+    return server
+
+# An opt-in sampling profiler. Every so often, we look at the stack of each of our threads and count it. Our stacks
+# are written out in the "folded" format (one line per stack), which flamegraph.pl and speedscope both understand.
+class SamplingProfiler:
+    def __init__(self, interval_seconds, output_location):
+        self.interval_seconds = interval_seconds
+        self.output_location = output_location
+        self.stacks = collections.Counter()
+        self.sample_count = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler', daemon=True)
+
+    def start(self):
+        logger.info(f'Sampling profiler has started (every {self.interval_seconds * 1000:.0f}ms).')
+        self.thread.start()
+        return self
+
+    def run(self):
+        profiler_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval_seconds):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == profiler_id:
+                    continue
+                stack = list()
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        if os.path.dirname(self.output_location) != '' and not os.path.exists(os.path.dirname(self.output_location)):
+            os.makedirs(os.path.dirname(self.output_location))
+        with open(self.output_location, 'w') as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f'{stack} {count}\n')
+        logger.info(f'Sampling profiler has stopped. Wrote {self.sample_count} samples to {self.output_location}.')
+
+def start_profiler(profiler_config, service_name):
+    if not profiler_config['enabled']:
+        return None
+    output_location = os.path.join(profiler_config['outputLocation'],
+                                   f'{service_name}-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.folded')
+    return SamplingProfiler(profiler_config['intervalMilliseconds'] / 1000.0, output_location).start()
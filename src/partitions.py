@@ -0,0 +1,61 @@
+import copy
+import glob
+import os
+import re
+import logging
+
+logger = logging.getLogger('PartitionService')
+logger.setLevel(logging.DEBUG)
+
+# Each partition (i.e. one Discord guild, or one trip) has its own database and columnar export. Requests to our
+# indexer name their partition with this header (requests without one go to our original, unpartitioned database).
+PARTITION_HEADER = 'X-Partition'
+
+# Our partition names end up in our file paths, so we are strict about what we accept (guild IDs always pass).
+PARTITION_PATTERN = re.compile(r'^[0-9A-Za-z_-]{1,64}$')
+
+class InvalidPartition(Exception):
+    pass
+
+def validate_partition(partition):
+    if partition is None:
+        return None
+    partition = str(partition)
+    if PARTITION_PATTERN.match(partition) is None:
+        raise InvalidPartition(f'Partition {partition} is not a valid partition name.')
+    return partition
+
+def resolve_config(config, partition, must_exist=False):
+    # Without a partition, we use our configuration as-is.
+    partition = validate_partition(partition)
+    if partition is None:
+        return config
+
+    # Otherwise, we point to our partition's own files, and apply any overrides (per section) for this partition.
+    resolved_config = copy.deepcopy(config)
+    for section_name, overrides in config['partitioning']['overrides'].get(partition, dict()).items():
+        resolved_config[section_name].update(overrides)
+    resolved_config['databaseDescription']['location'] = \
+        config['partitioning']['databaseLocation'].format(partition=partition)
+    resolved_config['databaseDescription']['columnarExportLocation'] = \
+        config['partitioning']['columnarExportLocation'].format(partition=partition)
+
+    # Only our indexer creates partitions. Everyone else (e.g. our website) may only open those that already exist.
+    if must_exist and not os.path.exists(resolved_config['databaseDescription']['location']):
+        raise InvalidPartition(f'Partition {partition} does not exist.')
+    return resolved_config
+
+def find_partitions(config):
+    # Our partitions are found by the databases they have left behind (i.e. those that match our location pattern).
+    location_prefix, location_suffix = config['partitioning']['databaseLocation'].split('{partition}', 1)
+    partition_names = list()
+    for location in glob.glob(glob.escape(location_prefix) + '*' + glob.escape(location_suffix)):
+        partition_name = location[len(location_prefix):len(location) - len(location_suffix)]
+        if PARTITION_PATTERN.match(partition_name) is not None:
+            partition_names.append(partition_name)
+    return sorted(partition_names)
+
+def ensure_directory(location):
+    if os.path.dirname(location) != '' and not os.path.exists(os.path.dirname(location)):
+        logger.info(f'Creating directory {os.path.dirname(location)}.')
+        os.makedirs(os.path.dirname(location))
@@ -8,16 +8,128 @@ import discord.interactions
 import discord.ext.commands
 import nltk.tokenize
 import nltk.corpus
-import emoji
 import os
+import sys
+import canonical
 import indexer
+import metrics
+import partitions
+import tokenizer
 import asyncio
 import collections
+import zlib
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
 logger = logging.getLogger('DiscordService')
 logger.setLevel(logging.DEBUG)
 
+# Each channel we scan is timed (labelled by how its scan ended), and each message we scan is counted.
+channel_scan_seconds = metrics.histogram('scraper_channel_scan_seconds', 'Time taken to scan each channel.',
+                                         ('result',))
+messages_scanned_total = metrics.counter('scraper_messages_scanned_total', 'Messages seen while scanning channels.',
+                                         ('result',))
+
+# We remember the last message we have scanned in each channel (i.e. our per-channel high-water marks).
+class ChannelMarks:
+    def __init__(self, location):
+        self.location = location
+        self.marks = dict()
+        if os.path.exists(self.location):
+            with open(self.location) as marks_file:
+                self.marks = json.load(marks_file)
+            logger.info(f'Loaded high-water marks for {len(self.marks)} channels.')
+
+    def get(self, channel_id):
+        mark = self.marks.get(str(channel_id))
+        return mark['message_id'] if mark is not None else None
+
+    def update(self, pending_marks):
+        for channel_id, mark in pending_marks.items():
+            current_mark = self.marks.get(str(channel_id))
+            if current_mark is None or current_mark['message_id'] < mark['message_id']:
+                self.marks[str(channel_id)] = mark
+
+        # Write to a temporary file first, so a crash mid-write never leaves us with a truncated file.
+        if os.path.dirname(self.location) != '' and not os.path.exists(os.path.dirname(self.location)):
+            os.makedirs(os.path.dirname(self.location))
+        with open(self.location + '.tmp', 'w') as marks_file:
+            json.dump(self.marks, marks_file)
+        os.replace(self.location + '.tmp', self.location)
+
+def build_inverted_map(index_entries):
+    inverted_map = dict()
+    for index_key, message_dict in index_entries:
+        # Messages with nothing left to search for (e.g. only emoji) are dropped.
+        if index_key == '':
+            continue
+        if index_key not in inverted_map:
+            inverted_map[index_key] = []
+        inverted_map[index_key].append(message_dict)
+    return inverted_map
+
+# Tagged messages (i.e. those with whitelisted reactions) change as gateway events arrive. We collect these changes
+# and push them to our indexer in small batches, once no new events have arrived for some time.
+class DeltaBatcher:
+    def __init__(self, debounce_seconds, flush_callback):
+        self.debounce_seconds = debounce_seconds
+        self.flush_callback = flush_callback
+        self.tagged_ids = set()
+        self.pending_index = dict()
+        self.pending_retract = set()
+        self.flush_handle = None
+
+    def tag(self, message_id, index_entry):
+        self.tagged_ids.add(message_id)
+        self.pending_index[message_id] = index_entry
+        self.schedule_flush()
+
+    def untag(self, message_id):
+        self.tagged_ids.discard(message_id)
+        self.pending_index.pop(message_id, None)
+        self.pending_retract.add(message_id)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush_handle = asyncio.get_running_loop().call_later(
+            self.debounce_seconds, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        index_entries, retracted_ids = self.pending_index, self.pending_retract
+        self.pending_index, self.pending_retract = dict(), set()
+        if len(index_entries) == 0 and len(retracted_ids) == 0:
+            return
+
+        # If our indexer could not accept this batch, put back whatever has not been superseded since.
+        if not await self.flush_callback(index_entries, retracted_ids):
+            logger.warning('Could not push delta batch to our indexer. Retrying later.')
+            self.pending_retract.update(retracted_ids)
+            for message_id, index_entry in index_entries.items():
+                if message_id in self.tagged_ids and message_id not in self.pending_index:
+                    self.pending_index[message_id] = index_entry
+            self.schedule_flush()
+
+# Our replies are edited as work progresses. Discord rate-limits message edits, so we only edit every so often.
+class ProgressReporter:
+    def __init__(self, reply_message, min_interval_seconds=2.0):
+        self.reply_message = reply_message
+        self.min_interval_seconds = min_interval_seconds
+        self.last_edit_time = 0.0
+
+    async def report(self, content, is_final=False):
+        now = asyncio.get_running_loop().time()
+        if not is_final and now - self.last_edit_time < self.min_interval_seconds:
+            return
+        self.last_edit_time = now
+        try:
+            await self.reply_message.edit(content=content)
+        except discord.errors.HTTPException as e:
+            logger.warning(f'Could not report progress: {e}')
+
 if __name__ == '__main__':
     dotenv.load_dotenv()
     with open('config/config.json') as config_file:
@@ -26,7 +138,7 @@ if __name__ == '__main__':
     # Pull the NLTK stopwords (we should only need to run this once)
     while True:
         try:
-            stopwords = set(nltk.corpus.stopwords.words('english'))
+            nltk.corpus.stopwords.words('english')
             break
         except LookupError:
             nltk.download('stopwords')
@@ -38,93 +150,373 @@ if __name__ == '__main__':
             break
         except LookupError:
             nltk.download('punkt')
+    if config['termCanonicalization']['lemmatize']:
+        canonical.download_corpora()
+
+    # Our metrics are served on their own port (our profiler is opt-in). We only log one of every so many of our
+    # ignored messages.
+    metrics_server = metrics.serve(config['metrics']['scraperPort'])
+    profiler = metrics.start_profiler(config['metrics']['profiler'], 'scraper')
+    ignored_log = metrics.LogSampler(logger, config['metrics']['logSampleEvery'])
+
+    # Our bot may be sharded across processes (e.g. "python src/scraper.py --shard 1"), in which case Discord gives each
+    # process its own share of our guilds. Each shard keeps its own high-water marks.
+    shard_count = config['discordSearch']['shardCount']
+    shard_id = int(sys.argv[sys.argv.index('--shard') + 1]) if '--shard' in sys.argv else 0
+    state_location = config['discordSearch']['stateLocation']
+    if shard_count > 1:
+        state_root, state_extension = os.path.splitext(state_location)
+        state_location = f'{state_root}-shard-{shard_id}{state_extension}'
+        logger.info(f'Running as shard {shard_id} of {shard_count}.')
 
     # Connect to Discord's API endpoint.
     intents = discord.Intents.default()
     intents.message_content = True
-    bot = discord.ext.commands.Bot(command_prefix='!', intents=intents)
+    if shard_count > 1:
+        bot = discord.ext.commands.Bot(command_prefix='!', intents=intents, shard_id=shard_id, shard_count=shard_count)
+    else:
+        bot = discord.ext.commands.Bot(command_prefix='!', intents=intents)
+    channel_marks = ChannelMarks(state_location)
 
     @bot.event
     async def on_ready():
         logger.info('Connected to Discord\'s endpoint.')
 
+    # All communication with our indexer goes through here. If we are partitioning, each guild's messages go to that
+    # guild's own partition.
+    indexer_endpoint = f'http://localhost:{config["serviceDescription"]["indexerPort"]}'
+    IndexerResponse = collections.namedtuple('IndexerResponse', 'response status')
+    is_partitioned = config['partitioning']['enabled']
+
+    def partition_headers(guild_id):
+        if not is_partitioned or guild_id is None:
+            return dict()
+        return {partitions.PARTITION_HEADER: str(guild_id)}
+
+    def website_address(guild_id):
+        address = 'https://' + config['serviceDescription']['websiteURL']
+        return address if not is_partitioned or guild_id is None else f'{address}?partition={guild_id}'
+
+    async def issue_request(op_code, payload, guild_id):
+        async with aiohttp.ClientSession() as session:
+            async with session.request(op_code, url=indexer_endpoint, json=payload,
+                                       headers=partition_headers(guild_id)) as r:
+                indexer_s = r.status
+                indexer_r = await r.text()
+                return IndexerResponse(indexer_r, indexer_s)
+
+    async def issue_stream_request(op_code, record_queue, guild_id):
+        is_compressed = config['discordSearch']['compressStream']
+
+        # Each record is written out as soon as it is put into our queue (a None marks the end of our stream).
+        async def stream_records():
+            compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if is_compressed else None
+            while True:
+                record = await record_queue.get()
+                if record is None:
+                    break
+                line = (json.dumps(record) + '\n').encode('UTF-8')
+                yield compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH) if is_compressed else line
+            if is_compressed:
+                yield compressor.flush()
+
+        # Our stream stays open for as long as our channels are being scanned, so only our reads are timed out.
+        headers = {'Content-Type': indexer.NDJSON_CONTENT_TYPE, **partition_headers(guild_id)}
+        if is_compressed:
+            headers['Content-Encoding'] = 'gzip'
+        stream_timeout = aiohttp.ClientTimeout(total=None, sock_read=config['serviceDescription']['streamReadSeconds'])
+        async with aiohttp.ClientSession(timeout=stream_timeout) as session:
+            async with session.request(op_code, url=indexer_endpoint, data=stream_records(), headers=headers) as r:
+                indexer_s = r.status
+                indexer_r = await r.text()
+                return IndexerResponse(indexer_r, indexer_s)
+
+    async def wait_for_job(job_id, progress):
+        async with aiohttp.ClientSession() as session:
+            while True:
+                async with session.get(f'{indexer_endpoint}/jobs/{job_id}') as r:
+                    job = await r.json()
+                if job['status'] in {indexer.JOB_STATUS_DONE, indexer.JOB_STATUS_FAILED}:
+                    return job
+
+                await progress.report(f'Searching Yelp... {job["terms_done"]}/{job["terms_total"]} search terms '
+                                      f'done ({len(job["empty_terms"])} without results, '
+                                      f'{len(job["error_terms"])} with errors).')
+                await asyncio.sleep(config['discordSearch']['jobPollSeconds'])
+
+    emoji_whitelist = config['discordSearch']['emojiWhitelist']
+
+    def is_tagged(message):
+        return not message.author.bot and any(m.emoji in emoji_whitelist for m in message.reactions)
+
+    message_tokenizer = tokenizer.Tokenizer(config['discordSearch']['tokenCacheLocation'],
+                                            config['discordSearch']['tokenizerWorkers'],
+                                            config['discordSearch']['tokenizerBatchSize'],
+                                            config['termCanonicalization']['lemmatize'])
+
+    async def tokenize_messages(messages):
+        tokenized = await message_tokenizer.tokenize([m.content for m in messages])
+        return [(index_key, {
+            'id': message.id,
+            'author': str(message.author.name),
+            'channel': str(message.channel.name),
+            'content': sanitized_message,
+            'created_at': str(message.created_at),
+            'jump_url': str(message.jump_url)
+        }) for message, (sanitized_message, index_key) in zip(messages, tokenized)]
+
+    async def push_deltas(guild_id, index_entries, retracted_ids):
+        # Retractions go first, so an edited message is removed under its old search term before being re-added. If
+        # our indexer can't be reached, our batch is given back to our batcher (to be retried later).
+        try:
+            if len(retracted_ids) > 0:
+                logger.info(f'Pushing {len(retracted_ids)} retracted messages to indexer at endpoint '
+                            f'{indexer_endpoint}.')
+                response = await issue_request(indexer.OP_CODE_RETRACT, list(retracted_ids), guild_id)
+                if response.status != 200:
+                    logger.error('Non-200 status from our indexer!')
+                    logger.error(response.response)
+                    return False
+
+            if len(index_entries) > 0:
+                inverted_map = build_inverted_map(index_entries.values())
+                logger.info(f'Pushing {len(index_entries)} tagged messages to indexer at endpoint {indexer_endpoint}.')
+                response = await issue_request(indexer.OP_CODE_INDEX, inverted_map, guild_id)
+                if response.status != 202:
+                    logger.error('Non-202 status from our indexer!')
+                    logger.error(response.response)
+                    return False
+
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            logger.error('Could not reach our indexer!')
+            logger.error(e)
+            return False
+
+        return True
+
+    # Each guild's changes are batched separately (a batch is always pushed to a single partition).
+    delta_batchers = dict()
+
+    def get_delta_batcher(guild_id):
+        if guild_id not in delta_batchers:
+            delta_batchers[guild_id] = DeltaBatcher(config['discordSearch']['eventDebounceSeconds'],
+                                                    lambda i, r: push_deltas(guild_id, i, r))
+        return delta_batchers[guild_id]
+
+    async def fetch_message(channel_id, message_id):
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            return None
+        try:
+            return await channel.fetch_message(message_id)
+        except (discord.errors.NotFound, discord.errors.Forbidden):
+            return None
+
+    @bot.event
+    async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+        delta_batcher = get_delta_batcher(payload.guild_id)
+        if str(payload.emoji) not in emoji_whitelist or payload.message_id in delta_batcher.tagged_ids:
+            return
+        message = await fetch_message(payload.channel_id, payload.message_id)
+        if message is not None and is_tagged(message):
+            logger.info(f'Message {message.id} has been tagged.')
+            delta_batcher.tag(message.id, (await tokenize_messages([message]))[0])
+
+    @bot.event
+    async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+        if str(payload.emoji) not in emoji_whitelist:
+            return
+
+        # The message is only untagged once its last whitelisted reaction has been removed.
+        message = await fetch_message(payload.channel_id, payload.message_id)
+        if message is None or not is_tagged(message):
+            logger.info(f'Message {payload.message_id} has been untagged.')
+            get_delta_batcher(payload.guild_id).untag(payload.message_id)
+
+    @bot.event
+    async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+        if 'content' not in payload.data:
+            return
+        message = await fetch_message(payload.channel_id, payload.message_id)
+        if message is not None and is_tagged(message):
+            logger.info(f'Tagged message {message.id} has been edited.')
+            index_entry = (await tokenize_messages([message]))[0]
+            delta_batcher = get_delta_batcher(payload.guild_id)
+            delta_batcher.untag(message.id)
+            delta_batcher.tag(message.id, index_entry)
+
+    # Most deleted messages were never tagged, so we only retract those that we know (or that discord.py still
+    # remembers) to have been tagged.
+    def was_tagged(delta_batcher, message_id, cached_message):
+        return message_id in delta_batcher.tagged_ids or (cached_message is not None and is_tagged(cached_message))
+
+    @bot.event
+    async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+        delta_batcher = get_delta_batcher(payload.guild_id)
+        if was_tagged(delta_batcher, payload.message_id, payload.cached_message):
+            delta_batcher.untag(payload.message_id)
+
+    @bot.event
+    async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+        delta_batcher = get_delta_batcher(payload.guild_id)
+        cached_messages = {m.id: m for m in payload.cached_messages}
+        for message_id in payload.message_ids:
+            if was_tagged(delta_batcher, message_id, cached_messages.get(message_id)):
+                delta_batcher.untag(message_id)
+
     @bot.command(name='refresh')
-    async def refresh_command(ctx: discord.ext.commands.Context):
-        await ctx.reply('Got it! Scraping and tokenizing all discord messages.')
-        emoji_whitelist = config['discordSearch']['emojiWhitelist']
-
-        # Iterate through each channel.
-        inverted_map = dict()
-        for channel in bot.get_all_channels():
-            if 'Text Channels' in channel.name or 'Voice Channels' in channel.name:
-                logger.info(f'Skipping through channel {channel.name}.')
-                continue
-            else:
+    async def refresh_command(ctx: discord.ext.commands.Context, mode: str = None):
+        # We only refresh the guild we have been asked from (our other guilds are left alone).
+        if ctx.guild is None:
+            await ctx.reply('Refreshes must be requested from a server channel!')
+            return
+        guild_id = ctx.guild.id
+
+        # By default, we only scan messages posted after our last refresh. "!refresh full" will rescan everything.
+        is_full_rescan = mode == 'full'
+        if is_full_rescan:
+            progress = ProgressReporter(await ctx.reply('Got it! Scraping and tokenizing all discord messages.'))
+        else:
+            progress = ProgressReporter(await ctx.reply('Got it! Scraping and tokenizing all new discord messages.'))
+
+        # Any reactions we have seen (in this guild) since our last flush should be sent out first.
+        delta_batcher = get_delta_batcher(guild_id)
+        await delta_batcher.flush()
+
+        # Scan each text channel concurrently (discord.py will respect Discord's rate-limit buckets for us). Our
+        # categories, voice, forum, and stage channels have no history of their own, so these are skipped.
+        channels = list(ctx.guild.text_channels)
+        channel_semaphore = asyncio.Semaphore(config['discordSearch']['maxConcurrentChannels'])
+        tagged_messages, channel_results, pending_marks = {c.id: list() for c in channels}, dict(), dict()
+        scanned_channels = list()
+
+        # When streaming, each channel's records are sent to our indexer as soon as that channel is done.
+        record_queue = asyncio.Queue() if config['discordSearch']['streamToIndexer'] else None
+
+        async def scan_channel(channel):
+            # Resume from our high-water mark (if we have one). We walk oldest-first, so a partial scan still leaves
+            # us with a valid mark.
+            last_message_id = None if is_full_rescan else channel_marks.get(channel.id)
+            after = discord.Object(id=last_message_id) if last_message_id is not None else None
+            async for message in channel.history(limit=None, after=after, oldest_first=True):
+                pending_marks[channel.id] = {'message_id': message.id, 'created_at': str(message.created_at)}
+                if message.author.bot:
+                    messages_scanned_total.inc(result='bot')
+                    ignored_log.debug('Bot message found. Ignoring.')
+                    continue
+                elif not is_tagged(message):
+                    messages_scanned_total.inc(result='untagged')
+                    ignored_log.debug('Ignoring message %s. No whitelisted reactions.', message.id)
+                    continue
+                else:
+                    messages_scanned_total.inc(result='tagged')
+                    delta_batcher.tagged_ids.add(message.id)
+                    tagged_messages[channel.id].append(message)
+
+        async def scan_channel_bounded(channel):
+            async with channel_semaphore:
                 logger.info(f'Iterating through channel {channel.name}.')
 
-            # Ensure we have access to the channel being scraped.
-            try:
-                async for message in channel.history(limit=None):
-                    if message.author.bot:
-                        logger.debug('Bot message found. Ignoring.')
-                        continue
-                    elif not any(m.emoji in emoji_whitelist for m in message.reactions):
-                        logger.debug(f'Ignoring message: "{message.content}". No whitelisted reactions.')
-                        continue
-                    else:
-                        sanitized_message = emoji.replace_emoji(message.content)
-                        logger.debug(f'Sanitized message fetch: "{sanitized_message}"')
-
-                        # Remove all stop-words from our message and insert this into our map.
-                        word_tokens = [
-                            w for w in nltk.tokenize.word_tokenize(sanitized_message) if not w.lower() in stopwords
-                        ]
-                        logger.debug(f'Message has been tokenized. Found {len(word_tokens)} tokens.')
-                        index_key = ' '.join(word_tokens)
-                        if index_key not in inverted_map:
-                            inverted_map[index_key] = []
-                        inverted_map[index_key].append({
-                            'id': message.id,
-                            'author': str(message.author.name),
-                            'channel': str(message.channel.name),
-                            'content': sanitized_message,
-                            'created_at': str(message.created_at),
-                            'jump_url': str(message.jump_url)
-                        })
-
-            except discord.errors.Forbidden:
-                logger.warning(f'Denied access to channel {channel.name}. Skipping.')
-
-        # Wrap our inverted map and send this to our indexer.
-        indexer_endpoint = f'http://localhost:{config["serviceDescription"]["indexerPort"]}'
-        logger.info(f'Pushing inverted map to indexer at endpoint {indexer_endpoint}.')
-
-        # TODO (GLENN): I'm sure there's a cleaner way to do this... but I don't know asyncio :-)
-        async def issue_request():
-            IndexerResponser = collections.namedtuple('IndexerResponse', 'response status')
-            async with aiohttp.ClientSession() as session:
-                async with session.request(indexer.OP_CODE_INDEX, url=indexer_endpoint, json=inverted_map) as r:
-                    indexer_s = r.status
-                    indexer_r = await r.text()
-                    return IndexerResponser(indexer_r, indexer_s)
+                # Ensure we have access to the channel being scraped (and that one slow channel can't hold us up).
+                scan_start_time = asyncio.get_running_loop().time()
+                try:
+                    await asyncio.wait_for(scan_channel(channel),
+                                           timeout=config['discordSearch']['channelTimeoutSeconds'])
+                    logger.info(f'Channel {channel.name} has been scanned. '
+                                f'Found {len(tagged_messages[channel.id])} tagged messages.')
+                    scan_result = 'scanned'
+                except discord.errors.Forbidden:
+                    logger.warning(f'Denied access to channel {channel.name}. Skipping.')
+                    scan_result = 'forbidden'
+                except discord.errors.HTTPException as e:
+                    # One bad channel shouldn't fail our whole refresh.
+                    logger.warning(f'Could not scan channel {channel.name} ({e}). '
+                                   f'Keeping the {len(tagged_messages[channel.id])} tagged messages found so far.')
+                    scan_result = 'error'
+                except asyncio.TimeoutError:
+                    logger.warning(f'Timed out while scanning channel {channel.name}. '
+                                   f'Keeping the {len(tagged_messages[channel.id])} tagged messages found so far.')
+                    scan_result = 'timeout'
+                channel_scan_seconds.observe(asyncio.get_running_loop().time() - scan_start_time, result=scan_result)
+
+            # Tokenize this channel's messages while other channels are still being scanned.
+            channel_results[channel.id] = await tokenize_messages(tagged_messages[channel.id])
+            if record_queue is not None:
+                for index_key, message_dicts in build_inverted_map(channel_results[channel.id]).items():
+                    record_queue.put_nowait({'search_term': index_key, 'messages': message_dicts})
+
+            # Report our progress.
+            scanned_channels.append(channel)
+            await progress.report(f'Scanned {len(scanned_channels)}/{len(channels)} channels '
+                                  f'(most recently #{channel.name}).', len(scanned_channels) == len(channels))
+
+        try:
+            if record_queue is not None:
+                # Our indexer will start searching for terms while we are still scanning the rest of our channels.
+                logger.info(f'Streaming records to indexer at endpoint {indexer_endpoint}.')
+                request_task = asyncio.ensure_future(issue_stream_request(indexer.OP_CODE_INDEX, record_queue,
+                                                                          guild_id))
+                try:
+                    await asyncio.gather(*[scan_channel_bounded(c) for c in channels])
+                except BaseException:
+                    # Our stream is closed without its end (so our indexer won't take this as a complete refresh).
+                    request_task.cancel()
+                    raise
+                record_queue.put_nowait(None)
+                response = await request_task
+
+            else:
+                await asyncio.gather(*[scan_channel_bounded(c) for c in channels])
+
+                # Merge each channel's messages into our inverted map, and send this to our indexer.
+                inverted_map = build_inverted_map(e for c in channels for e in channel_results[c.id])
+                logger.info(f'Pushing inverted map to indexer at endpoint {indexer_endpoint}.')
+                response = await issue_request(indexer.OP_CODE_INDEX, inverted_map, guild_id)
+
+            if response.status != 202:
+                logger.error('Non-202 status from our indexer!')
+                logger.error(response.response)
+                await ctx.reply('Error encountered! Report this to Glenn!')
+                return
+
+            # Follow our INDEX job until it has finished.
+            job = await wait_for_job(json.loads(response.response)['job_id'], progress)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Our high-water marks are left as they are (so our next refresh will pick these messages up again).
+            logger.error('Could not reach our indexer!')
+            logger.error(e)
+            await ctx.reply('Error encountered! Our indexer could not be reached. Report this to Glenn!')
+            return
+        if job['status'] != indexer.JOB_STATUS_DONE:
+            logger.error(f'INDEX job {job["job_id"]} has failed!')
+            logger.error(job['error'])
+            await ctx.reply('Error encountered! Report this to Glenn!')
+            return
+
+        if len(job['error_terms']) == 0:
+            # Only advance our high-water marks once the indexer has accepted all of our messages.
+            channel_marks.update(pending_marks)
+            logger.info(f'High-water marks have been advanced for {len(pending_marks)} channels.')
 
         # Finally, we'll exit by sending our user to the GUI.
-        response_list = await asyncio.gather(issue_request())
-        response = response_list[0]
-        website_address = 'https://' + config['serviceDescription']['websiteURL']
-        if response.status == 200:
-            await ctx.reply(f'Messages have been processed by the indexer. Visit {website_address} to see the updates!')
-
-        elif response.status == 199:
-            search_terms = response.response.split('no Yelp results:\n')[1]
-            await ctx.reply(f'Some messages yielded no results! The following search terms gave no results on the '
-                            f'Yelp search: {search_terms}\nBesides that... all other messages have been processed by '
-                            f'the indexer. Visit {website_address} to see the updates!')
+        guild_website_address = website_address(guild_id)
+        if len(job['empty_terms']) == 0 and len(job['error_terms']) == 0:
+            await ctx.reply(f'Messages have been processed by the indexer. '
+                            f'Visit {guild_website_address} to see the updates!')
 
         else:
-            logger.error('Non-200/199 status from our indexer!')
-            logger.error(response.response)
-            await ctx.reply('Error encountered! Report this to Glenn!')
+            warnings = list()
+            if len(job['empty_terms']) > 0:
+                search_terms = ','.join(f'"{s}"' for s in job['empty_terms'])
+                warnings.append(f'Some messages yielded no results! The following search terms gave no results on '
+                                f'the Yelp search: {search_terms}')
+            if len(job['error_terms']) > 0:
+                search_terms = ','.join(f'"{s}"' for s in job['error_terms'])
+                warnings.append(f'Some messages could not be searched! The following search terms will be retried '
+                                f'on the next refresh: {search_terms}')
+            await ctx.reply('\n'.join(warnings) + f'\nBesides that... all other messages have been processed by '
+                                                   f'the indexer. Visit {guild_website_address} to see the updates!')
 
     class HelpMenuView(discord.ui.View):
         @discord.ui.select(
@@ -141,15 +533,16 @@ if __name__ == '__main__':
 
             # Execute the help-menu command.
             if selected_option == 'website':
-                website_address = 'https://' + config['serviceDescription']['websiteURL']
-                return await interaction.response.send_message(f'The website is located at: {website_address}')
+                return await interaction.response.send_message(
+                    f'The website is located at: {website_address(interaction.guild_id)}')
             elif selected_option == 'refresh':
                 whitelisted_emojis = config['discordSearch']['emojiWhitelist']
                 return await interaction.response.send_message(
                     f'To add a new location to the website, add a new message to any channel and react with '
                     f'one of the following emojis: [{",".join(whitelisted_emojis)}]. You can also react '
                     f'to an existing message with one of previous emojis. Once react-ed, enter the command '
-                    f'"!refresh" into any channel.')
+                    f'"!refresh" into any channel. If you have react-ed to an old message, enter the command '
+                    f'"!refresh full" instead.')
             elif selected_option == 'delete':
                 return await interaction.response.send_message(
                     'To delete a location from the website, hover over the location you want to delete on '
@@ -163,3 +556,8 @@ if __name__ == '__main__':
     # Start our bot.
     logger.info('Starting bot.')
     bot.run(os.getenv('DISCORD_TOKEN'), log_handler=None)
+    message_tokenizer.shutdown()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if profiler is not None:
+        profiler.stop()
@@ -0,0 +1,565 @@
+import bisect
+import collections
+import database
+import json
+import math
+import mmap
+import os
+import re
+import metrics
+import sqlite3
+import struct
+import logging
+import numpy
+
+logger = logging.getLogger('SnapshotService')
+logger.setLevel(logging.DEBUG)
+
+# Our columnar export starts with a fixed header (magic, version, and the length of a JSON description of each
+# block), followed by each of our blocks. Every block begins on an 8-byte boundary, so each can be mapped as-is.
+EXPORT_MAGIC = b'JATRMAP1'
+EXPORT_HEADER_FORMAT = '<8sQQ'
+EXPORT_ALIGNMENT = 8
+
+# Our grid index buckets points into cells of this size (roughly 5km across, in Japan).
+GRID_CELL_DEGREES = 0.05
+
+# Our clusters are aggregated on a pyramid of grids. Each level doubles the size of the cells of the level below it
+# (every grid starts at -180 / -90, so the cells of each level are nested inside those of the level above it).
+CLUSTER_BASE_CELL_DEGREES = 0.005
+CLUSTER_LEVEL_COUNT = 13
+
+def align_to_block(size):
+    return (size + EXPORT_ALIGNMENT - 1) // EXPORT_ALIGNMENT * EXPORT_ALIGNMENT
+
+# Strings are stored as one UTF-8 buffer (plus the offsets of each string), so they too can be mapped from our export.
+class StringColumn:
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_strings(strings):
+        encoded = [(s or '').encode('utf-8') for s in strings]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.uint64)
+        numpy.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return StringColumn(offsets, numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if numpy.ndim(i) == 0:
+            return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+        return numpy.array([self[j] for j in numpy.asarray(i)], dtype=object)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+# Our points are bucketed into a grid of (latitude, longitude) cells, and are sorted by their cell. A viewport then
+# only looks at the cells it overlaps (each row of cells is one contiguous range), rather than at every point.
+class GridIndex:
+    def __init__(self, longitudes, latitudes, cell_degrees):
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.cell_degrees = cell_degrees
+        self.min_longitude = float(longitudes.min()) if len(longitudes) > 0 else 0.0
+        self.min_latitude = float(latitudes.min()) if len(latitudes) > 0 else 0.0
+        self.column_count = int(self.column_of(longitudes).max()) + 1 if len(longitudes) > 0 else 1
+        self.row_count = int(self.row_of(latitudes).max()) + 1 if len(latitudes) > 0 else 1
+
+        cells = self.row_of(latitudes) * self.column_count + self.column_of(longitudes)
+        self.order = numpy.argsort(cells, kind='stable')
+        self.sorted_cells = cells[self.order]
+
+    def column_of(self, longitudes):
+        return numpy.floor((numpy.asarray(longitudes) - self.min_longitude) / self.cell_degrees).astype(numpy.int64)
+
+    def row_of(self, latitudes):
+        return numpy.floor((numpy.asarray(latitudes) - self.min_latitude) / self.cell_degrees).astype(numpy.int64)
+
+    def query(self, min_longitude, max_longitude, min_latitude, max_latitude):
+        first_column = max(0, int(self.column_of(min_longitude)))
+        last_column = min(self.column_count - 1, int(self.column_of(max_longitude)))
+        first_row = max(0, int(self.row_of(min_latitude)))
+        last_row = min(self.row_count - 1, int(self.row_of(max_latitude)))
+        if len(self.order) == 0 or first_column > last_column or first_row > last_row:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        rows = numpy.arange(first_row, last_row + 1) * self.column_count
+        starts = numpy.searchsorted(self.sorted_cells, rows + first_column, side='left')
+        ends = numpy.searchsorted(self.sorted_cells, rows + last_column, side='right')
+        candidates = numpy.concatenate([self.order[s:e] for s, e in zip(starts, ends)])
+
+        # The cells on the border of our viewport may only be partially covered.
+        is_inside = ((self.longitudes[candidates] >= min_longitude) &
+                     (self.longitudes[candidates] <= max_longitude) &
+                     (self.latitudes[candidates] >= min_latitude) &
+                     (self.latitudes[candidates] <= max_latitude))
+        return numpy.sort(candidates[is_inside])
+
+# Points of interest are aggregated into (per-cell) clusters, carrying their count, average rating, and most common
+# category. The clusters of all of our points of interest are cached per level (i.e. once per snapshot).
+class ClusterPyramid:
+    def __init__(self, map_snapshot):
+        self.longitudes = map_snapshot.longitudes[map_snapshot.poi_locations]
+        self.latitudes = map_snapshot.latitudes[map_snapshot.poi_locations]
+        self.ratings = map_snapshot.ratings[map_snapshot.poi_locations]
+        self.category_names = map_snapshot.category_names
+
+        # We only consider the first (i.e. most relevant, according to Yelp) category of each location.
+        location_categories = numpy.full(len(map_snapshot.location_ids), -1, dtype=numpy.int64)
+        categorized_locations, first_entries = numpy.unique(map_snapshot.category_locations, return_index=True)
+        location_categories[categorized_locations] = map_snapshot.category_codes[first_entries]
+        self.category_codes = location_categories[map_snapshot.poi_locations]
+
+        self.level_cells = dict()
+        self.level_clusters = dict()
+
+    @staticmethod
+    def level_for(cell_degrees):
+        # We want the finest level whose cells are at least as large as asked for.
+        if cell_degrees <= CLUSTER_BASE_CELL_DEGREES:
+            return 0
+        return min(math.ceil(math.log2(cell_degrees / CLUSTER_BASE_CELL_DEGREES)), CLUSTER_LEVEL_COUNT - 1)
+
+    def cells(self, level):
+        if level not in self.level_cells:
+            cell_degrees = CLUSTER_BASE_CELL_DEGREES * 2 ** level
+            columns = numpy.floor((self.longitudes + 180.0) / cell_degrees).astype(numpy.int64)
+            rows = numpy.floor((self.latitudes + 90.0) / cell_degrees).astype(numpy.int64)
+            self.level_cells[level] = rows * (math.ceil(360.0 / cell_degrees) + 1) + columns
+        return self.level_cells[level]
+
+    def aggregate(self, level, poi_indices):
+        cells, cluster_of = numpy.unique(self.cells(level)[poi_indices], return_inverse=True)
+        counts = numpy.bincount(cluster_of, minlength=len(cells))
+        mean_of = lambda values: numpy.bincount(cluster_of, weights=values[poi_indices], minlength=len(cells)) / counts
+
+        # Our most common category is found by counting each (cluster, category) pair.
+        category_codes = self.category_codes[poi_indices]
+        is_categorized = category_codes >= 0
+        category_count = max(len(self.category_names), 1)
+        pairs, pair_counts = numpy.unique(cluster_of[is_categorized] * category_count + category_codes[is_categorized],
+                                          return_counts=True)
+        pair_clusters, pair_categories = pairs // category_count, pairs % category_count
+        pair_order = numpy.lexsort((-pair_counts, pair_clusters))
+        is_first_of_cluster = numpy.ones(len(pair_order), dtype=bool)
+        is_first_of_cluster[1:] = pair_clusters[pair_order][1:] != pair_clusters[pair_order][:-1]
+        top_pairs = pair_order[is_first_of_cluster]
+        top_categories = numpy.full(len(cells), '', dtype=object)
+        top_categories[pair_clusters[top_pairs]] = self.category_names[pair_categories[top_pairs]]
+
+        return {
+            'coord_longitude': mean_of(self.longitudes),
+            'coord_latitude': mean_of(self.latitudes),
+            'count': counts,
+            'rating': numpy.round(mean_of(self.ratings), 2),
+            'top_category': top_categories
+        }
+
+    def clusters(self, level, poi_indices=None):
+        # Without any indices, we give back the (cached) clusters of all of our points of interest.
+        if poi_indices is not None:
+            return self.aggregate(level, poi_indices)
+        if level not in self.level_clusters:
+            self.level_clusters[level] = self.aggregate(level, numpy.arange(len(self.longitudes)))
+        return self.level_clusters[level]
+
+# A read-only, columnar copy of everything our website displays. Snapshots are never modified once built, so they
+# can be shared between all of our Bokeh sessions (a new snapshot is built whenever our database changes).
+class MapSnapshot:
+    NUMERIC_COLUMNS = {
+        'latitudes': '<f8',
+        'longitudes': '<f8',
+        'ratings': '<f4',
+        'review_counts': '<i4',
+        'is_blacklisted': '|b1',
+        'poi_locations': '<i4',
+        'poi_message_ids': '<i8',
+        'poi_ranks': '<i4',
+        'category_locations': '<i4',
+        'category_codes': '<i4',
+        'alias_codes': '<i4'
+    }
+    STRING_COLUMNS = ('location_ids', 'names', 'yelp_urls', 'category_names', 'alias_names')
+
+    def __init__(self, version, columns, change_sequence):
+        self.version = version
+        self.change_sequence = change_sequence
+        self.grid = None
+        self.pyramid = None
+        for column_name in (*MapSnapshot.NUMERIC_COLUMNS, *MapSnapshot.STRING_COLUMNS):
+            setattr(self, column_name, columns[column_name])
+
+    @staticmethod
+    def from_database(cursor, version):
+        columns = dict()
+
+        # We remember the last change (of our change feed) that is reflected in our snapshot. This is read from SQLite's
+        # own sequence, which is kept even after our feed has been pruned...
+        cursor.execute("""
+            SELECT COALESCE(MAX(seq), 0)
+            FROM   sqlite_sequence
+            WHERE  name = 'ChangeFeed';
+        """)
+        change_sequence = cursor.fetchone()[0]
+
+        # ...our locations...
+        cursor.execute("""
+            SELECT   JL.id, JL.name, JL.yelp_url, JL.coord_latitude, JL.coord_longitude, JL.rating, JL.review_count,
+                     EXISTS ( SELECT 1
+                              FROM   BlacklistedLocations BL
+                              WHERE  BL.id = JL.id )
+            FROM     JapanLocations JL
+            ORDER BY JL.id;
+        """)
+        location_rows = cursor.fetchall()
+        columns['location_ids'] = StringColumn.from_strings([r[0] for r in location_rows])
+        columns['names'] = StringColumn.from_strings([r[1] for r in location_rows])
+        columns['yelp_urls'] = StringColumn.from_strings([r[2] for r in location_rows])
+        for i, column_name in enumerate(['latitudes', 'longitudes', 'ratings', 'review_counts', 'is_blacklisted']):
+            columns[column_name] = numpy.array([r[i + 3] for r in location_rows],
+                                               dtype=MapSnapshot.NUMERIC_COLUMNS[column_name])
+        location_index = {r[0]: i for i, r in enumerate(location_rows)}
+
+        # ...our (already ranked) points of interest, in the order we display them (this is a total order, so that our
+        # website can page through them by key)...
+        cursor.execute("""
+            SELECT   POI.location_id, POI.message_id, POI.rank
+            FROM     PointsOfInterest POI
+            ORDER BY POI.rank, POI.review_count DESC, POI.location_id, POI.message_id;
+        """)
+        poi_rows = [r for r in cursor.fetchall() if r[0] in location_index]
+        columns['poi_locations'] = numpy.array([location_index[r[0]] for r in poi_rows], dtype='<i4')
+        columns['poi_message_ids'] = numpy.array([r[1] for r in poi_rows], dtype='<i8')
+        columns['poi_ranks'] = numpy.array([r[2] for r in poi_rows], dtype='<i4')
+
+        # ...and our categories (stored as codes into our category / alias names).
+        cursor.execute("""
+            SELECT   id, category, alias
+            FROM     JapanLocationsCategories
+            ORDER BY rowid;
+        """)
+        category_rows = [r for r in cursor.fetchall() if r[0] in location_index]
+        columns['category_locations'] = numpy.array([location_index[r[0]] for r in category_rows], dtype='<i4')
+        for i, column_name in [(1, 'category'), (2, 'alias')]:
+            names, codes = numpy.unique(numpy.array([r[i] or '' for r in category_rows], dtype=object),
+                                        return_inverse=True)
+            columns[f'{column_name}_names'] = StringColumn.from_strings(names)
+            columns[f'{column_name}_codes'] = codes.astype('<i4')
+
+        return MapSnapshot(version, columns, change_sequence)
+
+    @staticmethod
+    def from_export(location):
+        # Our arrays are views over the mapped file (i.e. nothing is copied). The page cache holding our file is
+        # shared with every other process that has mapped the same version.
+        with open(location, 'rb') as export_file:
+            mapping = mmap.mmap(export_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = struct.unpack_from(EXPORT_HEADER_FORMAT, mapping, 0)
+        if magic != EXPORT_MAGIC:
+            raise ValueError(f'File {location} is not a columnar export!')
+        header_offset = struct.calcsize(EXPORT_HEADER_FORMAT)
+        header = json.loads(mapping[header_offset:header_offset + header_length])
+        blocks = header['blocks']
+        data_offset = align_to_block(header_offset + header_length)
+
+        def map_block(block_name):
+            block = blocks[block_name]
+            return numpy.frombuffer(mapping, dtype=numpy.dtype(block['dtype']), count=block['count'],
+                                    offset=data_offset + block['offset'])
+
+        columns = {column_name: map_block(column_name) for column_name in MapSnapshot.NUMERIC_COLUMNS}
+        for column_name in MapSnapshot.STRING_COLUMNS:
+            columns[column_name] = StringColumn(map_block(f'{column_name}.offsets'), map_block(f'{column_name}.data'))
+        return MapSnapshot(version, columns, header['change_sequence'])
+
+    def export_blocks(self):
+        for column_name in MapSnapshot.NUMERIC_COLUMNS:
+            yield column_name, getattr(self, column_name)
+        for column_name in MapSnapshot.STRING_COLUMNS:
+            yield f'{column_name}.offsets', getattr(self, column_name).offsets
+            yield f'{column_name}.data', getattr(self, column_name).data
+
+    def __len__(self):
+        return len(self.poi_locations)
+
+    @staticmethod
+    def like_to_regex(pattern):
+        # We mimic SQLite's (case-insensitive) LIKE.
+        translated = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern)
+        return re.compile(f'^{translated}$', re.IGNORECASE | re.DOTALL)
+
+    def locations_in_categories(self, category=None, alias=None):
+        matching_entries = numpy.zeros(len(self.category_locations), dtype=bool)
+        if category is not None:
+            category_regex = MapSnapshot.like_to_regex(category)
+            matching_codes = [i for i, c in enumerate(self.category_names) if category_regex.match(c)]
+            matching_entries |= numpy.isin(self.category_codes, matching_codes)
+        if alias is not None:
+            alias_regex = MapSnapshot.like_to_regex(alias)
+            matching_codes = [i for i, a in enumerate(self.alias_names) if alias_regex.match(a)]
+            matching_entries |= numpy.isin(self.alias_codes, matching_codes)
+
+        location_mask = numpy.zeros(len(self.location_ids), dtype=bool)
+        location_mask[self.category_locations[matching_entries]] = True
+        return location_mask
+
+    def locations_with_ids(self, location_ids):
+        # Our location IDs are sorted, so each is found with a binary search.
+        location_mask = numpy.zeros(len(self.location_ids), dtype=bool)
+        for location_id in location_ids:
+            i = bisect.bisect_left(self.location_ids, location_id)
+            if i < len(self.location_ids) and self.location_ids[i] == location_id:
+                location_mask[i] = True
+        return location_mask
+
+    def select(self, category=None, alias=None, location_ids=None):
+        # Returns the (ordered) indices of all points of interest that satisfy our filters. A point of interest must
+        # match either of our category / alias, and must be one of our locations (if these are given).
+        if category is None and alias is None and location_ids is None:
+            return numpy.arange(len(self.poi_locations))
+        location_mask = numpy.ones(len(self.location_ids), dtype=bool)
+        if category is not None or alias is not None:
+            location_mask &= self.locations_in_categories(category, alias)
+        if location_ids is not None:
+            location_mask &= self.locations_with_ids(location_ids)
+        return numpy.flatnonzero(location_mask[self.poi_locations])
+
+    def sort_key(self, poi_index):
+        location = self.poi_locations[poi_index]
+        return (int(self.poi_ranks[poi_index]), -int(self.review_counts[location]), self.location_ids[location],
+                int(self.poi_message_ids[poi_index]))
+
+    def seek(self, key, poi_indices=None):
+        # Returns the position (among all of our points of interest, or among the given ones) of the first point of
+        # interest at or after our key. Our points of interest are sorted by their key, so this is a binary search.
+        low, high = 0, len(self) if poi_indices is None else len(poi_indices)
+        while low < high:
+            middle = (low + high) // 2
+            if self.sort_key(middle if poi_indices is None else poi_indices[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def within_bounds(self, min_longitude, max_longitude, min_latitude, max_latitude):
+        # Returns the (ordered) indices of all points of interest inside our bounds. Our grid is built on first use,
+        # and is then shared by all of our sessions.
+        if self.grid is None:
+            self.grid = GridIndex(self.longitudes[self.poi_locations], self.latitudes[self.poi_locations],
+                                  GRID_CELL_DEGREES)
+        return self.grid.query(min_longitude, max_longitude, min_latitude, max_latitude)
+
+    def cluster_pyramid(self):
+        # Like our grid, our pyramid is built on first use.
+        if self.pyramid is None:
+            self.pyramid = ClusterPyramid(self)
+        return self.pyramid
+
+    def centroid(self, group_rank):
+        selected_locations = self.poi_locations[self.poi_ranks <= group_rank]
+        if len(selected_locations) == 0:
+            return {'longitude': None, 'latitude': None}
+        return {'longitude': float(self.longitudes[selected_locations].mean()),
+                'latitude': float(self.latitudes[selected_locations].mean())}
+
+    def columns(self, poi_indices):
+        locations = self.poi_locations[poi_indices]
+        return {
+            'location_id': self.location_ids[locations],
+            'message_id': self.poi_message_ids[poi_indices],
+            'rank': self.poi_ranks[poi_indices],
+            'name': self.names[locations],
+            'yelp_url': self.yelp_urls[locations],
+            'coord_latitude': self.latitudes[locations],
+            'coord_longitude': self.longitudes[locations],
+            'rating': self.ratings[locations],
+            'review_count': self.review_counts[locations]
+        }
+
+def read_snapshot(conn, version):
+    # All of our columns are read within a single transaction (so they are consistent with one another). Our
+    # connection must be in autocommit mode (i.e. isolation_level=None).
+    conn.execute('BEGIN;')
+    try:
+        return MapSnapshot.from_database(conn.cursor(), version)
+    finally:
+        conn.execute('COMMIT;')
+
+def read_export_version(location):
+    try:
+        with open(location, 'rb') as export_file:
+            magic, version, _ = struct.unpack(EXPORT_HEADER_FORMAT,
+                                              export_file.read(struct.calcsize(EXPORT_HEADER_FORMAT)))
+        return version if magic == EXPORT_MAGIC else 0
+    except (OSError, struct.error):
+        return 0
+
+def write_export(map_snapshot, location):
+    blocks, block_offset = dict(), 0
+    for block_name, array in map_snapshot.export_blocks():
+        blocks[block_name] = {'dtype': array.dtype.str, 'offset': block_offset, 'count': len(array)}
+        block_offset += align_to_block(array.nbytes)
+    header = json.dumps({'blocks': blocks, 'change_sequence': map_snapshot.change_sequence}).encode('utf-8')
+    header_size = struct.calcsize(EXPORT_HEADER_FORMAT) + len(header)
+
+    # Our new version is written to the side, and then renamed over our old version (which stays valid for any
+    # process that still has it mapped).
+    temporary_location = f'{location}.tmp'
+    with open(temporary_location, 'wb') as export_file:
+        export_file.write(struct.pack(EXPORT_HEADER_FORMAT, EXPORT_MAGIC, map_snapshot.version, len(header)))
+        export_file.write(header)
+        export_file.write(b'\0' * (align_to_block(header_size) - header_size))
+        for _, array in map_snapshot.export_blocks():
+            export_file.write(array.tobytes())
+            export_file.write(b'\0' * (align_to_block(array.nbytes) - array.nbytes))
+        export_file.flush()
+        os.fsync(export_file.fileno())
+    os.replace(temporary_location, location)
+
+# Each record of our change feed. Sessions apply these to what they have already sent to their browser.
+Change = collections.namedtuple('Change', ['sequence', 'kind', 'message_id', 'location_id'])
+
+# There is one store per process. Our snapshot is only ever replaced (never modified), so a session holding onto an
+# old snapshot will always see a consistent view of our data.
+class SnapshotStore:
+    def __init__(self, db_location, export_location=None, change_history=10000):
+        self.db_location = db_location
+        self.export_location = export_location
+        self.export_stat = None
+        self.conn = None
+        self.snapshot = None
+        self.changes = collections.deque(maxlen=change_history)
+        self.changes_start = None
+        self.refresh_if_changed()
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(f'file:{self.db_location}?mode=ro', uri=True, isolation_level=None,
+                                        factory=metrics.TimedConnection)
+        return self.conn
+
+    def tail_changes(self, old_snapshot, new_snapshot):
+        # We only read the changes that are reflected in our new snapshot (so sessions never apply a change before
+        # its data is available to them).
+        if old_snapshot is not None:
+            try:
+                cursor = self.connect().cursor()
+                cursor.execute("""
+                    SELECT   sequence, kind, message_id, location_id
+                    FROM     ChangeFeed
+                    WHERE    sequence > ? AND 
+                             sequence <= ?
+                    ORDER BY sequence;
+                """, (old_snapshot.change_sequence, new_snapshot.change_sequence))
+                new_changes = [Change(*row) for row in cursor.fetchall()]
+
+                # If our feed has been pruned past our old snapshot, we cannot give our sessions every change.
+                if new_snapshot.change_sequence == old_snapshot.change_sequence or \
+                        (len(new_changes) > 0 and new_changes[0].sequence == old_snapshot.change_sequence + 1):
+                    self.changes.extend(new_changes)
+                    self.changes_start = self.changes[0].sequence if len(self.changes) > 0 else \
+                        new_snapshot.change_sequence + 1
+                    return
+
+            except sqlite3.Error as e:
+                logger.error('Could not read our change feed!')
+                logger.error(e)
+
+        self.changes.clear()
+        self.changes_start = new_snapshot.change_sequence + 1
+
+    def changes_since(self, change_sequence):
+        # Returns None if we no longer hold every change after the given sequence.
+        if change_sequence + 1 < self.changes_start:
+            return None
+        return [c for c in self.changes if c.sequence > change_sequence]
+
+    def search_locations(self, text, limit):
+        # Our search index lives in our database (i.e. not in our snapshot).
+        try:
+            return database.search_locations(self.connect().cursor(), text, limit)
+        except sqlite3.Error as e:
+            logger.error('Could not search our database!')
+            logger.error(e)
+            return list()
+
+    def replace_snapshot(self, new_snapshot):
+        self.tail_changes(self.snapshot, new_snapshot)
+        self.snapshot = new_snapshot
+
+    def refresh_if_changed(self):
+        # We prefer the export published by our indexer (this is shared with all of our other processes). If there
+        # is no export, we build our snapshot from our database ourselves.
+        if self.export_location is not None and os.path.exists(self.export_location):
+            return self.refresh_from_export()
+        return self.refresh_from_database()
+
+    def refresh_from_export(self):
+        # A new version is always a new file (our indexer renames over the old one).
+        try:
+            export_stat = os.stat(self.export_location)
+            export_key = (export_stat.st_ino, export_stat.st_mtime_ns, export_stat.st_size)
+            if self.export_stat == export_key:
+                return False
+            new_snapshot = MapSnapshot.from_export(self.export_location)
+
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.error('Could not map our columnar export!')
+            logger.error(e)
+            return False
+
+        self.export_stat = export_key
+        self.replace_snapshot(new_snapshot)
+        logger.info(f'Snapshot has been mapped from export version {new_snapshot.version}. '
+                    f'We have {len(new_snapshot)} points of interest.')
+        return True
+
+    def refresh_from_database(self):
+        # SQLite's data_version changes whenever another connection commits to our database.
+        try:
+            data_version = self.connect().execute('PRAGMA data_version;').fetchone()[0]
+            if self.snapshot is not None and self.export_stat is None and self.snapshot.version == data_version:
+                return False
+            new_snapshot = read_snapshot(self.conn, data_version)
+
+        except sqlite3.Error as e:
+            logger.error('Encountered error with our database!')
+            logger.error(e)
+            return False
+
+        self.export_stat = None
+        self.replace_snapshot(new_snapshot)
+        logger.info(f'Snapshot has been refreshed. We have {len(new_snapshot)} points of interest.')
+        return True
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+class SnapshotUnavailable(Exception):
+    pass
+
+# Each of our processes keeps one store per database (i.e. per partition), which is shared by all of its sessions. We
+# only keep the stores of databases that we could load (so our sessions can't fill this with stores of their own).
+stores = dict()
+
+def get_store(db_location, export_location=None):
+    if db_location not in stores:
+        snapshot_store = SnapshotStore(db_location, export_location)
+        if snapshot_store.snapshot is None:
+            snapshot_store.close()
+            raise SnapshotUnavailable(f'Could not load a snapshot of database {db_location}.')
+        stores[db_location] = snapshot_store
+    return stores[db_location]
+
+def refresh_stores():
+    for snapshot_store in list(stores.values()):
+        snapshot_store.refresh_if_changed()
+
+def close_stores():
+    for snapshot_store in stores.values():
+        snapshot_store.close()
+    stores.clear()
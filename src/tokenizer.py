@@ -0,0 +1,110 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sqlite3
+import asyncio
+import canonical
+import metrics
+import emoji
+import nltk.tokenize
+import nltk.corpus
+
+logger = logging.getLogger('TokenizerService')
+logger.setLevel(logging.DEBUG)
+
+# Bump this whenever our tokenization changes, so that cached results from an older version are never used.
+TOKENIZER_VERSION = 2
+
+# Each worker process loads its own stopwords (once) when it starts.
+stopwords = None
+is_lemmatizing = False
+
+def initialize_worker(lemmatize):
+    global stopwords, is_lemmatizing
+    stopwords = set(nltk.corpus.stopwords.words('english'))
+    is_lemmatizing = lemmatize
+
+def tokenize_content(content):
+    sanitized_message = emoji.replace_emoji(content)
+
+    # Remove all stop-words from our message. Our index key is the canonical form of the remaining tokens.
+    word_tokens = [
+        w for w in nltk.tokenize.word_tokenize(sanitized_message) if not w.lower() in stopwords
+    ]
+    return sanitized_message, canonical.canonicalize_term(' '.join(word_tokens), is_lemmatizing)
+
+def tokenize_batch(contents):
+    return [tokenize_content(c) for c in contents]
+
+def content_hash(content, lemmatize):
+    return hashlib.sha256(f'{TOKENIZER_VERSION}:{int(lemmatize)}:{content}'.encode('UTF-8')).hexdigest()
+
+# Tokenized messages are cached by the hash of their content, so unchanged messages are never re-tokenized.
+class TokenCache:
+    def __init__(self, location):
+        if os.path.dirname(location) != '' and not os.path.exists(os.path.dirname(location)):
+            os.makedirs(os.path.dirname(location))
+        self.conn = sqlite3.connect(location, factory=metrics.TimedConnection)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS TokenizedContent (
+                content_hash      TEXT PRIMARY KEY,
+                sanitized_message TEXT NOT NULL,
+                index_key         TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def get_many(self, hashes):
+        results = dict()
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            for row in self.conn.execute(f"""
+                SELECT content_hash, sanitized_message, index_key
+                FROM   TokenizedContent
+                WHERE  content_hash IN ({','.join('?' for _ in chunk)});
+            """, chunk):
+                results[row[0]] = (row[1], row[2])
+        return results
+
+    def put_many(self, entries):
+        self.conn.executemany("""
+            INSERT INTO TokenizedContent (content_hash, sanitized_message, index_key)
+            VALUES                       (?, ?, ?)
+            ON CONFLICT (content_hash) DO NOTHING;
+        """, [(h, e[0], e[1]) for h, e in entries.items()])
+        self.conn.commit()
+
+# The sanitize / tokenize / stopword step is CPU work, so we keep it off of our event loop.
+class Tokenizer:
+    def __init__(self, cache_location, max_workers, batch_size, lemmatize=False):
+        self.cache = TokenCache(cache_location)
+        self.batch_size = batch_size
+        self.lemmatize = lemmatize
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                               initializer=initialize_worker,
+                                                               initargs=(lemmatize,))
+
+    async def tokenize(self, contents):
+        hashes = [content_hash(c, self.lemmatize) for c in contents]
+        cached = self.cache.get_many(list(set(hashes)))
+
+        # Only contents we have never seen before are sent to our workers.
+        uncached = list({h: c for h, c in zip(hashes, contents) if h not in cached}.items())
+        logger.debug('Tokenizing %d messages. %d are cached.', len(contents), len(contents) - len(uncached))
+        if len(uncached) > 0:
+            loop = asyncio.get_running_loop()
+            batches = [uncached[i:i + self.batch_size] for i in range(0, len(uncached), self.batch_size)]
+            batch_results = await asyncio.gather(*[
+                loop.run_in_executor(self.executor, tokenize_batch, [c for _, c in batch]) for batch in batches
+            ])
+            tokenized = dict()
+            for batch, results in zip(batches, batch_results):
+                tokenized.update({h: r for (h, _), r in zip(batch, results)})
+            self.cache.put_many(tokenized)
+            cached.update(tokenized)
+
+        return [cached[h] for h in hashes]
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -1,119 +1,304 @@
-import sqlite3
-import sys
+import os
+import time
 import dotenv
+import bokeh.events
 import bokeh.io
 import bokeh.layouts
 import bokeh.models
 import bokeh.plotting
 import logging
-import pandas
+import metrics
+import numpy
+import snapshot
 
 logger = logging.getLogger('WebsiteLayoutService')
 logger.setLevel(logging.DEBUG)
 
+# Our views are timed (labelled by whether our selection had to be recomputed).
+refresh_view_seconds = metrics.histogram('website_refresh_view_seconds', 'Time taken by each refresh of our view.',
+                                         ('selection',))
+
 class WebsiteLayout:
-    def refresh_view(self, limit, offset=0, category=None, alias=None):
-        try:
-            # We don't have built-in UDFs... :-(
-            logger.info('Dropping old view PointsOfInterest.')
-            self.cursor.execute("""
-                DROP VIEW IF EXISTS PointsOfInterest;
-            """)
-
-            # Build our "categories" clause (we'll keep the parameterizing for SQLite).
-            categories_clause = None
-            categories_params = tuple()
-            if category is not None or alias is not None:
-                category_join = """
-                    EXISTS     ( SELECT 1
-                                 FROM   JapanLocationsCategories JLC 
-                                 WHERE  JLC.id = JLI.id AND {} )
-                """
-                if category is not None and alias is not None:
-                    categories_clause = category_join.format("( JLC.category LIKE ? OR JLC.alias LIKE ? )")
-                    categories_params = (category, alias,)
-
-                elif category is not None and alias is None:
-                    categories_clause = category_join.format("JLC.category LIKE ?")
-                    categories_params = (category,)
-
-                elif category is None and alias is not None:
-                    categories_clause = category_join.format("JLC.alias LIKE ?")
-                    categories_params = (alias,)
-
-            logger.info('Creating PointsOfInterest view.')
-            self.cursor.execute(f"""
-                CREATE   TEMPORARY VIEW PointsOfInterest ( location_id,
-                                                           message_id,
-                                                           review_count,
-                                                           rank )
-                AS
-                SELECT   JLI.id                                  AS location_id,
-                         MJL.discord_message_id                  AS message_id,
-                         JLI.review_count                        AS review_count,
-                         RANK() OVER (
-                            PARTITION BY MJL.discord_message_id
-                            ORDER BY     JLI.review_count DESC ) AS rank
-                FROM     JapanLocations JLI,
-                         MessagesToJapanLocations MJL
-                WHERE    MJL.japan_locations_id = JLI.id AND
-                         NOT EXISTS ( SELECT 1
-                                      FROM   BlacklistedLocations BL
-                                      WHERE  BL.id = JLI.id )
-                         {("AND " + categories_clause) if categories_clause is not None else ""}
-                LIMIT    ?
-                OFFSET   ?;
-            """, categories_params + (limit, offset,))
-
-        except sqlite3.Error as e:
-            logger.error('Encountered error with our database!')
-            logger.error(e)
+    def refresh_view(self, limit, start_key=None, category=None, alias=None, search=None, changes=None):
+        # We only remember our filters and which points of interest (in our shared snapshot) they select. Our
+        # selection is only recomputed if our snapshot or our categories / search have changed.
+        start_time = time.perf_counter()
+        self.view_filters = {'limit': limit, 'start_key': start_key, 'category': category, 'alias': alias,
+                             'search': search}
+        is_selection_stale = self.store.snapshot is not self.view_snapshot or \
+            self.view_selection_filters != (category, alias, search)
+        if is_selection_stale:
+            logger.info('Selecting from our PointsOfInterest snapshot.')
+            self.view_snapshot = self.store.snapshot
+            location_ids = None if search is None else self.search_locations(search)
+            self.view_selection = None if category is None and alias is None and search is None else \
+                self.view_snapshot.select(category, alias, location_ids)
+            self.view_selection_filters = (category, alias, search)
+
+        # Our page starts at a key (rather than at an offset), so it stays put while our indexer adds points of
+        # interest before it. Finding our key is a binary search, so a page deep in our list costs the same as our
+        # first page.
+        self.view_start = 0 if start_key is None else self.view_snapshot.seek(start_key, self.view_selection)
+        if self.view_selection is None:
+            self.view_indices = numpy.arange(self.view_start, min(self.view_start + limit, len(self.view_snapshot)))
+        else:
+            self.view_indices = self.view_selection[self.view_start:self.view_start + limit]
+        self.view_cluster_cache = dict()
+
+        if self.range_slider is not None:
+            self.range_slider.end = max(self.view_selection_size(), 1)
+            self.range_slider.value = (self.view_start, self.view_start + len(self.view_indices))
+        if self.map_source is not None:
+            self.refresh_map(changes)
+        refresh_view_seconds.observe(time.perf_counter() - start_time,
+                                     selection='recomputed' if is_selection_stale else 'cached')
+
+    def search_locations(self, text):
+        # Returns the IDs of the locations whose names, categories, or messages match our text (best match first).
+        return self.store.search_locations(text, self.config['bokehLayout']['searchResultLimit'])
+
+    def view_selection_size(self):
+        return len(self.view_snapshot) if self.view_selection is None else len(self.view_selection)
+
+    def view_key_at(self, position):
+        # Returns the key of the point of interest at the given position of our selection.
+        if self.view_selection_size() == 0:
+            return None
+        position = min(position, self.view_selection_size() - 1)
+        return self.view_snapshot.sort_key(position if self.view_selection is None else self.view_selection[position])
+
+    def view_columns(self):
+        return self.view_snapshot.columns(self.view_indices)
+
+    def on_snapshot_check(self):
+        # Our process-wide snapshot may have been replaced since we last looked. If so, re-apply our filters. Our
+        # browser is only sent what has changed (if our store still holds every change since our last snapshot).
+        if self.store.snapshot is not self.view_snapshot:
+            changes = self.store.changes_since(self.view_snapshot.change_sequence)
+            logger.info(f'Snapshot has changed. Refreshing our view '
+                        f'({"all points" if changes is None else f"{len(changes)} changes"}).')
+            self.refresh_view(**self.view_filters, changes=changes)
+
+    def view_clusters(self, level):
+        # Our clusters are cached for as long as our view stays the same. A view of every point of interest shares
+        # the clusters cached by our snapshot.
+        if level not in self.view_cluster_cache:
+            is_unfiltered = len(self.view_indices) == len(self.view_snapshot)
+            self.view_cluster_cache[level] = self.view_snapshot.cluster_pyramid().clusters(
+                level, None if is_unfiltered else self.view_indices)
+        return self.view_cluster_cache[level]
+
+    def send_points(self, visible_indices, changes=None):
+        new_columns = self.view_snapshot.columns(visible_indices)
+        new_keys = list(zip(new_columns['message_id'].tolist(), new_columns['location_id'].tolist()))
+        new_rows = {key: i for i, key in enumerate(new_keys)}
+        if changes is not None and self.map_rows is not None:
+            # Bokeh cannot remove rows, so the rows that have left our view are hidden (by clearing their coordinates).
+            # Once more rows are hidden than are shown, we send everything again.
+            hidden_keys = [key for key in self.map_rows if key not in new_rows]
+            if self.map_row_count - len(self.map_rows) + len(hidden_keys) <= len(new_keys):
+                self.send_changed_points(new_columns, new_keys, new_rows, hidden_keys, changes)
+                return
+
+        self.map_source.data = new_columns
+        self.map_rows = new_rows
+        self.map_row_count = len(new_keys)
+
+    def send_changed_points(self, new_columns, new_keys, new_rows, hidden_keys, changes):
+        # Rows whose message or location appears in our change feed are patched, and new rows are streamed. A change to
+        # a location may re-rank every other location of the same message, so we treat its messages as changed too.
+        changed_messages = {c.message_id for c in changes if c.message_id is not None}
+        changed_locations = {c.location_id for c in changes if c.location_id is not None}
+        changed_messages.update(key[0] for key in self.map_rows if key[1] in changed_locations)
+        patched_keys = [key for key in self.map_rows if key in new_rows and key[0] in changed_messages]
+        added_rows = [i for i, key in enumerate(new_keys) if key not in self.map_rows]
+        as_python = lambda v: v.item() if isinstance(v, numpy.generic) else v
+
+        patches = {column_name: list() for column_name in new_columns}
+        for key in hidden_keys:
+            row = self.map_rows.pop(key)
+            patches['coord_latitude'].append((row, float('nan')))
+            patches['coord_longitude'].append((row, float('nan')))
+        for key in patched_keys:
+            for column_name, column in new_columns.items():
+                patches[column_name].append((self.map_rows[key], as_python(column[new_rows[key]])))
+        patches = {column_name: patch for column_name, patch in patches.items() if len(patch) > 0}
+        if len(patches) > 0:
+            self.map_source.patch(patches)
+
+        if len(added_rows) > 0:
+            self.map_source.stream({column_name: column[added_rows] for column_name, column in new_columns.items()})
+            for i in added_rows:
+                self.map_rows[new_keys[i]] = self.map_row_count
+                self.map_row_count += 1
+        logger.debug(f'Sent {len(added_rows)} new, {len(patched_keys)} changed, and {len(hidden_keys)} hidden points '
+                     f'of interest to our map.')
+
+    def refresh_map(self, changes=None):
+        # Only the points of interest (of our view) that are inside our map's viewport are sent to our browser. Until
+        # our browser tells us where it is looking, we consider everything in our view.
+        if self.map_bounds is None:
+            visible_indices = self.view_indices
+            locations = self.view_snapshot.poi_locations[visible_indices]
+            map_bounds = {
+                'min_longitude': self.view_snapshot.longitudes[locations].min(initial=180.0),
+                'max_longitude': self.view_snapshot.longitudes[locations].max(initial=-180.0),
+                'min_latitude': self.view_snapshot.latitudes[locations].min(initial=90.0),
+                'max_latitude': self.view_snapshot.latitudes[locations].max(initial=-90.0)
+            }
+        else:
+            map_bounds = self.map_bounds
+            viewport_indices = self.view_snapshot.within_bounds(**map_bounds)
+            visible_indices = viewport_indices[numpy.isin(viewport_indices, self.view_indices)]
+
+        # Once we are zoomed in far enough, we send our individual points. Otherwise, we send clusters (their cells
+        # are sized relative to the width of our viewport).
+        layout_config = self.config['bokehLayout']
+        if len(visible_indices) <= layout_config['maxMapPoints']:
+            logger.debug(f'Sending {len(visible_indices)} points of interest to our map.')
+            self.send_points(visible_indices, changes)
+            self.cluster_source.data = {'coord_longitude': [], 'coord_latitude': [], 'count': [], 'rating': [],
+                                        'top_category': [], 'size': []}
+            return
+
+        viewport_width = map_bounds['max_longitude'] - map_bounds['min_longitude']
+        level = snapshot.ClusterPyramid.level_for(viewport_width / layout_config['clusterGridColumns'])
+        cluster_columns = self.view_clusters(level)
+        is_inside = ((cluster_columns['coord_longitude'] >= map_bounds['min_longitude']) &
+                     (cluster_columns['coord_longitude'] <= map_bounds['max_longitude']) &
+                     (cluster_columns['coord_latitude'] >= map_bounds['min_latitude']) &
+                     (cluster_columns['coord_latitude'] <= map_bounds['max_latitude']))
+        logger.debug(f'Sending {numpy.count_nonzero(is_inside)} clusters (at level {level}) to our map.')
+        self.map_source.data = self.view_snapshot.columns(visible_indices[:0])
+        self.map_rows = None
+        self.cluster_source.data = {k: v[is_inside] for k, v in cluster_columns.items()} | {
+            'size': numpy.clip(10.0 + 4.0 * numpy.log2(cluster_columns['count'][is_inside]), 10.0, 40.0)
+        }
+
+    def on_map_ranges_update(self, event):
+        self.map_bounds = {'min_longitude': event.x0, 'max_longitude': event.x1,
+                           'min_latitude': event.y0, 'max_latitude': event.y1}
+        self.map_changed_at = time.monotonic()
+        if not self.is_map_refresh_pending:
+            self.is_map_refresh_pending = True
+            self.document.add_timeout_callback(self.on_map_debounce,
+                                               self.config['bokehLayout']['mapDebounceMilliseconds'])
+
+    def on_map_debounce(self):
+        # We only refresh our map once our viewport has stopped moving (i.e. not on every step of a pan or zoom).
+        debounce_seconds = self.config['bokehLayout']['mapDebounceMilliseconds'] / 1000.0
+        quiet_seconds = time.monotonic() - self.map_changed_at
+        if quiet_seconds < debounce_seconds:
+            self.document.add_timeout_callback(self.on_map_debounce, (debounce_seconds - quiet_seconds) * 1000.0)
+            return
+        self.is_map_refresh_pending = False
+        self.refresh_map()
 
     def __init__(self, **kwargs):
         self.config = kwargs
         dotenv.load_dotenv()
-        self.data_frame = pandas.DataFrame()
-
-        # Open a connection to our database.
-        try:
-            db_location = self.config['databaseDescription']['location']
-            self.conn = sqlite3.connect(db_location)
-            self.conn.row_factory = sqlite3.Row
-            self.cursor = self.conn.cursor()
-
-            # Set up our initial view. There are no restrictions on keywords.
-            initial_data_range = self.config['bokehLayout']['initialDataRange']
-            self.refresh_view(limit=initial_data_range[1], offset=initial_data_range[0])
-
-            # Determine our centroid range.
-            initial_group_rank = self.config['bokehLayout']['initialGroupRank']
-            self.cursor.execute("""
-                WITH   CoordinatesOfInterest AS ( SELECT JL.coord_latitude,
-                                                         JL.coord_longitude
-                                                  FROM   PointsOfInterest POI,
-                                                         JapanLocations JL
-                                                  WHERE  POI.location_id = JL.id AND 
-                                                         POI.r_number <= ? )
-                SELECT AVG(COI.coord_latitude)  AS avg_latitude,
-                       AVG(COI.coord_longitude) AS avg_longitude
-                FROM   CoordinatesOfInterest COI;
-            """, (initial_group_rank,))
-            centroid_tuple = self.cursor.fetchone()
-            self.centroid = {'longitude': centroid_tuple['avg_longitude'], 'latitude': centroid_tuple['avg_latitude']}
-
-        except sqlite3.Error as e:
-            logger.error('Encountered error with our database!')
-            logger.error(e)
-            sys.exit(1)
+        self.view_snapshot = None
+        self.view_selection_filters = None
+        self.range_slider = None
+        self.map_source = None
+        self.map_rows = None
+        self.map_row_count = 0
+        self.cluster_source = None
+        self.map_bounds = None
+        self.map_changed_at = 0.0
+        self.is_map_refresh_pending = False
+
+        # All of our sessions (in this process) share the same snapshot of our database. If this can't be loaded,
+        # our caller is given a SnapshotUnavailable.
+        self.store = snapshot.get_store(self.config['databaseDescription']['location'],
+                                        self.config['databaseDescription']['columnarExportLocation'])
+
+        # Set up our initial view. There are no restrictions on keywords.
+        initial_data_range = self.config['bokehLayout']['initialDataRange']
+        initial_limit = initial_data_range[1] - initial_data_range[0]
+        self.refresh_view(limit=initial_limit)
+        if initial_data_range[0] > 0:
+            self.refresh_view(limit=initial_limit, start_key=self.view_key_at(initial_data_range[0]))
+
+        # Determine our centroid range. Without any points of interest (e.g. a new partition), we use our default.
+        initial_group_rank = self.config['bokehLayout']['initialGroupRank']
+        self.centroid = self.view_snapshot.centroid(initial_group_rank)
+        if self.centroid['latitude'] is None or self.centroid['longitude'] is None:
+            self.centroid = dict(self.config['bokehLayout']['defaultMapCenter'])
+
+    def on_range_change(self, attr, old, new):
+        start, end = int(new[0]), int(new[1])
+        self.refresh_view(limit=max(end - start, 0), start_key=self.view_key_at(start),
+                          category=self.view_filters['category'], alias=self.view_filters['alias'],
+                          search=self.view_filters['search'])
+
+    def on_search_input(self, attr, old, new):
+        # We search as our user types. A new search starts back at the top of our list.
+        self.refresh_view(limit=self.view_filters['limit'], category=self.view_filters['category'],
+                          alias=self.view_filters['alias'], search=new if new.strip() != '' else None)
+
+    def generate_search_input(self, **kwargs):
+        search_input = bokeh.models.TextInput(
+            title='Search',
+            placeholder='Search by name, category, or Discord message...',
+            **kwargs
+        )
+        search_input.on_change('value_input', self.on_search_input)
+        return search_input
 
     def generate_range_tool(self, **kwargs):
-        raise NotImplementedError
+        # Our slider picks a window of our (ranked) points of interest. We only hear about the window once our user has
+        # let go of the slider, and each window is turned into a key (see refresh_view).
+        self.range_slider = bokeh.models.RangeSlider(
+            start=0,
+            end=max(self.view_selection_size(), 1),
+            value=(self.view_start, self.view_start + len(self.view_indices)),
+            step=1,
+            title='Points of Interest (by Rank)',
+            **kwargs
+        )
+        self.range_slider.on_change('value_throttled', self.on_range_change)
+        return self.range_slider
 
     def generate_map(self, **kwargs):
-        raise NotImplementedError
+        self.document = bokeh.io.curdoc()
+        map_options = bokeh.models.GMapOptions(
+            lat=self.centroid['latitude'],
+            lng=self.centroid['longitude'],
+            map_type=self.config['bokehLayout']['mapType'],
+            zoom=self.config['bokehLayout']['initialMapZoom']
+        )
+        map_figure = bokeh.plotting.gmap(os.getenv('GOOGLE_API_KEY'), map_options,
+                                         tools='pan,wheel_zoom,reset,tap', active_scroll='wheel_zoom', **kwargs)
+
+        # Our glyphs are fed from our viewport (we hear about each pan / zoom through RangesUpdate). Depending on our
+        # zoom, we either show individual points or clusters.
+        self.map_source = bokeh.models.ColumnDataSource()
+        self.cluster_source = bokeh.models.ColumnDataSource()
+        self.refresh_map()
+        point_renderer = map_figure.circle(x='coord_longitude', y='coord_latitude', source=self.map_source,
+                                           size=9, fill_color='firebrick', fill_alpha=0.8, line_color='white')
+        cluster_renderer = map_figure.circle(x='coord_longitude', y='coord_latitude', source=self.cluster_source,
+                                             size='size', fill_color='darkorange', fill_alpha=0.6, line_color='white')
+        map_figure.add_tools(bokeh.models.HoverTool(renderers=[point_renderer], tooltips=[
+            ('Name', '@name'),
+            ('Rating', '@rating'),
+            ('Reviews', '@review_count'),
+            ('Rank', '@rank')
+        ]))
+        map_figure.add_tools(bokeh.models.HoverTool(renderers=[cluster_renderer], tooltips=[
+            ('Locations', '@count'),
+            ('Average Rating', '@rating'),
+            ('Top Category', '@top_category')
+        ]))
+        map_figure.select_one(bokeh.models.TapTool).renderers = [point_renderer]
+        map_figure.select_one(bokeh.models.TapTool).callback = bokeh.models.OpenURL(url='@yelp_url')
+        map_figure.on_event(bokeh.events.RangesUpdate, self.on_map_ranges_update)
+        return map_figure
 
     def __call__(self, *args, **kwargs):
         return bokeh.layouts.column(
+            self.generate_search_input(sizing_mode='inherit'),
             self.generate_range_tool(sizing_mode='inherit'),
             self.generate_map(sizing_mode='inherit'),
             sizing_mode='stretch_width'
@@ -0,0 +1,243 @@
+import concurrent.futures
+import canonical
+import datetime
+import json
+import logging
+import metrics
+import os
+import sqlite3
+import random
+import threading
+import time
+import urllib.parse
+import requests
+import requests.adapters
+
+logger = logging.getLogger('YelpClient')
+logger.setLevel(logging.DEBUG)
+
+# Each attempt at a Yelp search is timed (labelled by its HTTP status, or "error" if Yelp could not be reached).
+request_seconds = metrics.histogram('yelp_request_seconds', 'Time taken by each request to Yelp.', ('status',))
+cache_lookups_total = metrics.counter('yelp_cache_lookups_total', 'Lookups of our Yelp search cache.', ('result',))
+
+class YelpError(Exception):
+    pass
+
+class YelpQuotaExceeded(YelpError):
+    pass
+
+# We are allowed a fixed number of queries per second (and per day) by Yelp.
+class TokenBucket:
+    def __init__(self, queries_per_second, daily_quota):
+        self.queries_per_second = queries_per_second
+        self.daily_quota = daily_quota
+        self.tokens = float(queries_per_second)
+        self.last_refill = time.monotonic()
+        self.quota_day = datetime.datetime.utcnow().date()
+        self.quota_used = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                # Our daily quota resets at midnight (UTC).
+                today = datetime.datetime.utcnow().date()
+                if today != self.quota_day:
+                    self.quota_day, self.quota_used = today, 0
+                if self.quota_used >= self.daily_quota:
+                    raise YelpQuotaExceeded(f'Daily quota of {self.daily_quota} requests has been used.')
+
+                # Refill our bucket, and take a token if one is available.
+                now = time.monotonic()
+                self.tokens = min(float(self.queries_per_second),
+                                  self.tokens + (now - self.last_refill) * self.queries_per_second)
+                self.last_refill = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.quota_used += 1
+                    return
+                wait_time = (1.0 - self.tokens) / self.queries_per_second
+            time.sleep(wait_time)
+
+# Raw Yelp responses are kept around, so we never pay for the same search twice (e.g. after a database reset).
+class YelpSearchCache:
+    def __init__(self, location, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+        if os.path.dirname(location) != '' and not os.path.exists(os.path.dirname(location)):
+            os.makedirs(os.path.dirname(location))
+        self.conn = sqlite3.connect(location, check_same_thread=False, factory=metrics.TimedConnection)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS YelpSearchResponses (
+                cache_key   TEXT PRIMARY KEY,
+                response    TEXT NOT NULL,
+                fetched_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS YelpSearchResponsesAccessedAt ON YelpSearchResponses (accessed_at);
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(search_term, location, limit, locale):
+        # Variants of the same term share one cached response (our canonical form is idempotent, so terms that are
+        # already canonical are left as-is).
+        return json.dumps([canonical.canonicalize_term(search_term), location.casefold(), limit, locale])
+
+    def get(self, cache_key, ignore_ttl=False):
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT response, fetched_at
+                FROM   YelpSearchResponses
+                WHERE  cache_key = ?;
+            """, (cache_key,)).fetchone()
+            if row is None or (not ignore_ttl and time.time() - row[1] > self.ttl_seconds):
+                self.misses += 1
+                cache_lookups_total.inc(result='miss')
+                return None
+
+            # Remember when we last used this entry (for our LRU eviction).
+            self.conn.execute("""
+                UPDATE YelpSearchResponses
+                SET    accessed_at = ?
+                WHERE  cache_key = ?;
+            """, (time.time(), cache_key))
+            self.conn.commit()
+            self.hits += 1
+            cache_lookups_total.inc(result='hit')
+            return json.loads(row[0])
+
+    def put(self, cache_key, response):
+        with self.lock:
+            now = time.time()
+            self.conn.execute("""
+                INSERT INTO YelpSearchResponses (cache_key, response, fetched_at, accessed_at)
+                VALUES                          (?, ?, ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET response    = excluded.response,
+                                                      fetched_at  = excluded.fetched_at,
+                                                      accessed_at = excluded.accessed_at;
+            """, (cache_key, json.dumps(response), now, now))
+
+            # Evict our least-recently-used entries if we are over our size cap.
+            self.conn.execute("""
+                DELETE FROM YelpSearchResponses
+                WHERE       cache_key IN ( SELECT   cache_key
+                                           FROM     YelpSearchResponses
+                                           ORDER BY accessed_at DESC
+                                           LIMIT    -1
+                                           OFFSET   ? );
+            """, (self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class YelpClient:
+    def __init__(self, token, **kwargs):
+        self.token = token
+        self.config = kwargs
+        self.bucket = TokenBucket(self.config['queriesPerSecond'], self.config['dailyQuota'])
+        self.cache = YelpSearchCache(self.config['cache']['location'], self.config['cache']['ttlSeconds'],
+                                     self.config['cache']['maxEntries'])
+
+        # In replay-only mode, we never issue a request to Yelp (e.g. for benchmarking without a network).
+        self.is_replay_only = self.config['cache']['replayOnly']
+        if self.is_replay_only:
+            logger.info('Replay-only mode is enabled. All searches will be answered from our cache.')
+
+        # All of our workers share a pool of keep-alive connections.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.config['maxConcurrentRequests'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config['maxConcurrentRequests'],
+                                                              thread_name_prefix='YelpWorker')
+
+    def search(self, search_term, is_revalidation=False):
+        # Revalidations always go to Yelp (although their responses are still cached for our next INDEX).
+        cache_key = YelpSearchCache.make_key(search_term, self.config['location'], self.config['limit'],
+                                             self.config['locale'])
+        cached_response = None if is_revalidation else self.cache.get(cache_key, ignore_ttl=self.is_replay_only)
+        if cached_response is not None:
+            logger.debug('Search term %s has been found in our cache.', search_term)
+            return cached_response
+        elif self.is_replay_only:
+            raise YelpError(f'Search term {search_term} is not in our cache (and we are in replay-only mode).')
+
+        yelp_response = self.fetch(search_term)
+        self.cache.put(cache_key, yelp_response)
+        return yelp_response
+
+    def fetch(self, search_term):
+        url = self.config['endpoint'] + '?' + \
+              urllib.parse.urlencode({
+                  'location': self.config['location'],
+                  'limit': self.config['limit'],
+                  'term': search_term,
+                  'sort_by': 'best_match',
+                  'locale': self.config['locale']
+              }, safe="()", quote_via=urllib.parse.quote)
+        headers = {
+            'accept': 'application/json',
+            'Authorization': f'Bearer {self.token}'
+        }
+
+        # Retry on 429s, 5XXs, and connection errors (with jittered exponential backoff).
+        for attempt in range(self.config['maxRetries'] + 1):
+            self.bucket.acquire()
+            backoff_time = self.config['backoffSeconds'] * (2 ** attempt) * random.uniform(0.5, 1.5)
+            start_time = time.perf_counter()
+            try:
+                yelp_response = self.session.get(url, headers=headers, timeout=self.config['timeoutSeconds'])
+            except (requests.ConnectionError, requests.Timeout) as e:
+                request_seconds.observe(time.perf_counter() - start_time, status='error')
+                logger.warning(f'Could not reach Yelp for search term {search_term}: {e}')
+                time.sleep(backoff_time)
+                continue
+            except requests.RequestException as e:
+                # Anything else (e.g. too many redirects) won't be fixed by retrying.
+                request_seconds.observe(time.perf_counter() - start_time, status='error')
+                raise YelpError(f'Could not search Yelp for search term {search_term}: {e}') from e
+            request_seconds.observe(time.perf_counter() - start_time, status=yelp_response.status_code)
+
+            if yelp_response.ok:
+                # Our callers only ever see a YelpError (so one bad response never takes down a whole batch).
+                try:
+                    yelp_json = yelp_response.json()
+                except (ValueError, requests.RequestException) as e:
+                    raise YelpError(f'Yelp has returned a malformed body for search term {search_term}: {e}') from e
+                if not isinstance(yelp_json, dict) or not isinstance(yelp_json.get('businesses'), list):
+                    raise YelpError(f'Yelp has returned a body without businesses for search term {search_term}.')
+                return yelp_json
+            elif yelp_response.status_code == 429 or yelp_response.status_code >= 500:
+                logger.warning(f'Yelp has returned {yelp_response.status_code} for search term {search_term}. '
+                               f'Retrying (attempt {attempt + 1}).')
+                retry_after = yelp_response.headers.get('Retry-After')
+                time.sleep(float(retry_after) if retry_after is not None and retry_after.isdigit() else backoff_time)
+            else:
+                raise YelpError(f'Yelp has returned {yelp_response.status_code} for search term {search_term}: '
+                                f'{yelp_response.content}')
+
+        raise YelpError(f'Yelp could not process search term {search_term} after '
+                        f'{self.config["maxRetries"] + 1} attempts.')
+
+    def submit(self, search_term, is_revalidation=False):
+        return self.executor.submit(self.search, search_term, is_revalidation)
+
+    def search_many(self, search_terms, is_revalidation=False):
+        # Results are given back as soon as they are available (i.e. not in the order they were given to us).
+        futures = {self.submit(t, is_revalidation): t for t in search_terms}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except YelpError as e:
+                yield futures[future], None, e
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.session.close()
+        self.cache.close()